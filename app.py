@@ -1,26 +1,29 @@
 import asyncio
-import json
 import sys
 import threading
 import time
 from functools import wraps
+from typing import Any, Dict
 from niobot import NioBot, Context, MatrixRoom, RoomMessage
 
 from configs import EnvConfig
-from services import MatrixClient, SillyTavernServer, EventTracker
+from services import MatrixClient, SillyTavernServer, EventTracker, AdmissionController, SearchIndex, TrafficRecorder
+from services.admission_control import GENERATION, EDIT, COMMAND
+from services.traffic_recorder import MATRIX_IN
 
 
 def bot_execute_command(command: str, has_args: bool = False):
     def decorator(func):
         @wraps(func)
         async def wrapper(ctx: Context, *args, **kwargs):
+            if not await admit_or_notify(COMMAND, ctx.event.sender, ctx.room.room_id):
+                return
             # 先执行函数体，可能有额外逻辑
             await func(ctx, *args, **kwargs)
             # 然后构建 payload
-            payload_dict = {"type": "execute_command", "command": command, "chatId": ctx.event.event_id}
+            payload = {"type": "execute_command", "command": command, "chatId": ctx.event.event_id}
             if has_args and args:
-                payload_dict["args"] = args[0]
-            payload = json.dumps(payload_dict)
+                payload["args"] = args[0]
             await send_message_sf(payload, ctx.room.room_id)
             await asyncio.sleep(1)
             await matrix_client.delete_text(ctx.room.room_id, ctx.event.event_id)
@@ -31,6 +34,8 @@ def bot_execute_command(command: str, has_args: bool = False):
 def bot_command_delete(func):
     @wraps(func)
     async def wrapper(ctx: Context, *args, **kwargs):
+        if not await admit_or_notify(COMMAND, ctx.event.sender, ctx.room.room_id):
+            return
         await func(ctx, *args, **kwargs)
         await asyncio.sleep(1)
         await matrix_client.delete_text(ctx.room.room_id, ctx.event.event_id)
@@ -48,17 +53,39 @@ bot = NioBot(
     owner_id=cfg.mx_owner_id,
 )
 matrix_client = MatrixClient(bot, cfg, logger)
+search_index = SearchIndex(cfg, logger)
+traffic_recorder = TrafficRecorder(cfg, logger)
 event_tracker = EventTracker(matrix_client, cfg, logger)
-silly_tavern_server = SillyTavernServer(matrix_client, event_tracker, cfg, logger)
+silly_tavern_server = SillyTavernServer(
+    matrix_client,
+    event_tracker,
+    cfg,
+    logger,
+    search_index=search_index,
+    traffic_recorder=traffic_recorder,
+)
+admission_controller = AdmissionController(cfg, logger)
+# 派发用户消息前的等待（秒），回放工具按倍速缩短
+DISPATCH_DELAY = 3.0
+
+
+async def admit_or_notify(kind: str, sender: str, room_id: str) -> bool:
+    """限流检查；超限时丢弃事件，并在该房间限频发送一条提示。"""
+    if admission_controller.admit(kind, sender, room_id):
+        return True
+    if admission_controller.should_notify(room_id):
+        event_id = await matrix_client.send_text("消息过于频繁，部分请求已被忽略，请稍后再试。", room_id)
+        event_tracker.track_trash_event_id(event_id)
+    return False
 
 
 async def newchat(room_id: str, event_id: str) -> None:
-    payload = json.dumps({"type": "execute_command", "command": "new", "chatId": event_id})
+    payload = {"type": "execute_command", "command": "new", "chatId": event_id}
     await send_message_sf(payload, room_id)
 
 
 async def delmessages(room_id: str, event_id: str, num: int) -> None:
-    payload = json.dumps({"type": "execute_command", "command": "del", "chatId": event_id, "args": num})
+    payload = {"type": "execute_command", "command": "del", "chatId": event_id, "args": num}
     await send_message_sf(payload, room_id)
 
 
@@ -90,16 +117,18 @@ async def should_ignore_message(sender, content, body, room_id, event_id, event:
     return False
 
 
-async def send_message_sf(payload: str, room_id: str) -> None:
+async def send_message_sf(payload: Dict[str, Any], room_id: str) -> None:
     silly_tavern_server.room_id = room_id
-    message = json.loads(payload)
-    event_id = message.get("chatId", None)
+    event_id = payload.get("chatId", None)
     if event_id is None:
         return
 
     if silly_tavern_server.server and silly_tavern_server.server.state == 1:
-        await silly_tavern_server.server.send(payload)
+        await silly_tavern_server.send(payload)
         event_tracker.track_event_id(silly_tavern_server.thread_id, event_id)
+        if payload.get("type") == "user_message":
+            # 回复生成期间提前准备好加密会话
+            matrix_client.schedule_prewarm(room_id)
 
 
 @bot.command()
@@ -134,6 +163,17 @@ async def switchchat(ctx: Context, inx: int) -> None:
     silly_tavern_server.thread_id = None
 
 
+@bot.command()
+@bot_command_delete
+async def backfill(ctx: Context, chat_name: str = "") -> None:
+    if not (silly_tavern_server.server and silly_tavern_server.server.state == 1):
+        event_id = await matrix_client.send_text("SillyTavern未连接，无法回填聊天记录。", ctx.room.room_id)
+        event_tracker.track_trash_event_id(event_id)
+        return
+
+    await silly_tavern_server.start_backfill(ctx.room.room_id, ctx.event.event_id, chat_name)
+
+
 @bot.command()
 @bot_execute_command("listchars")
 async def listchars(ctx: Context) -> None:
@@ -164,12 +204,25 @@ async def cleartrash(ctx: Context) -> None:
 
 @bot.command()
 @bot_command_delete
-async def listthreads(ctx: Context) -> None:
-    threads_md = event_tracker.list_threads_markdown()
+async def listthreads(ctx: Context, page: int = 1) -> None:
+    threads_md = event_tracker.list_threads_markdown(page=page)
     event_id = await matrix_client.send_text(f"已知会话线程列表：\n{threads_md}", ctx.room.room_id)
     event_tracker.track_trash_event_id(event_id)
 
 
+@bot.command()
+@bot_command_delete
+async def search(ctx: Context, query: str, page: int = 1) -> None:
+    page_size = 10
+    # 已被删除的消息不再出现在结果中
+    results = search_index.search(
+        query, ctx.room.room_id, page=page, page_size=page_size, alive=event_tracker.has_tracked
+    )
+    results_md = search_index.format_results_markdown(query, results, page, page_size)
+    event_id = await matrix_client.send_text(results_md, ctx.room.room_id)
+    event_tracker.track_trash_event_id(event_id)
+
+
 @bot.command()
 @bot_command_delete
 async def removethread(ctx: Context, thread_id: str) -> None:
@@ -184,8 +237,7 @@ async def removethread(ctx: Context, thread_id: str) -> None:
         return
 
     await event_tracker.delete_events_after(ctx.room.room_id, thread_id, num=len(event_tracker.ordered_events))
-    del event_tracker.thread[thread_id]
-    event_tracker._save_state()
+    event_tracker.remove_thread(thread_id)
     event_id = await matrix_client.send_text("已删除线程ID。", ctx.room.room_id)
     event_tracker.track_trash_event_id(event_id)
 
@@ -199,10 +251,18 @@ async def on_message(room: MatrixRoom, event: RoomMessage):
     content = event.source["content"]
     body = content["body"]
     event_id = event.event_id
+    traffic_recorder.record(MATRIX_IN, event.source, room_id)
 
     if await should_ignore_message(sender, content, body, room_id, event_id, event):
         return
 
+    replaced_event_id = None
+    if content.get("m.relates_to", {}).get("rel_type") == "m.replace":
+        replaced_event_id = content["m.relates_to"]["event_id"]
+    regenerate = replaced_event_id is not None and event_tracker.has_tracked(replaced_event_id)
+    if not await admit_or_notify(EDIT if regenerate else GENERATION, sender, room_id):
+        return
+
     thread_id = None
     if content.get("m.relates_to", {}).get("rel_type") == "m.thread":
         thread_id = content["m.relates_to"]["event_id"]
@@ -213,17 +273,15 @@ async def on_message(room: MatrixRoom, event: RoomMessage):
         # 同时在 EventTracker 中注册该线程，供后续列出
         event_tracker.register_thread(event_id, body[:10])
 
-    replaced_event_id = None
-    if content.get("m.relates_to", {}).get("rel_type") == "m.replace":
-        replaced_event_id = content["m.relates_to"]["event_id"]
-    if replaced_event_id is not None and event_tracker.has_tracked(replaced_event_id):
+    if regenerate:
         # 如果是重复处理的event，打断并删除后续所有消息
         del_num = await event_tracker.delete_events_after(room_id, silly_tavern_server.thread_id, replaced_event_id)
         await delmessages(room_id, event.event_id, del_num)
 
     logger.info("New message received from %s", sender)
-    payload = json.dumps({"type": "user_message", "chatId": event_id, "text": body})
-    await asyncio.sleep(3)
+    search_index.add(room_id, silly_tavern_server.thread_id, event_id, "user", body)
+    payload = {"type": "user_message", "chatId": event_id, "text": body}
+    await asyncio.sleep(DISPATCH_DELAY)
     await send_message_sf(payload, room_id)
 
 
@@ -1,7 +1,7 @@
 import os
 import logging
 from dataclasses import dataclass, field
-from typing import Dict
+from typing import Dict, Tuple
 from urllib.parse import urlparse
 from dotenv import load_dotenv
 
@@ -10,6 +10,24 @@ logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(mess
 logger = logging.getLogger("rss_forwarder")
 
 
+# 令牌桶配置：(容量, 补满所需秒数)，None 表示不限制
+RateLimit = Tuple[float, float] | None
+
+
+def _parse_rate_limit(name: str) -> RateLimit:
+    """解析形如 "5/60"（60 秒内最多 5 次）的限流配置。"""
+    value = os.getenv(name, "").strip()
+    if not value:
+        return None
+    try:
+        capacity, period = (float(v) for v in value.split("/", 1))
+    except ValueError:
+        raise RuntimeError(f"Invalid rate limit for {name}: {value!r}, expected <count>/<seconds>")
+    if capacity <= 0 or period <= 0:
+        raise RuntimeError(f"Invalid rate limit for {name}: {value!r}, values must be positive")
+    return capacity, period
+
+
 @dataclass
 class EnvConfig:
     mx_homeserver: str
@@ -19,7 +37,20 @@ class EnvConfig:
     mx_owner_id: str
     mx_store_path: str = "./matrix_store"
     mx_encryption_enabled: bool = False
+    mx_e2ee_prewarm: bool = True
+    mx_e2ee_warm_interval: float = 30.0
+    mx_segment_max_bytes: int = 48000
+    traffic_record_path: str | None = None
     wss_port: int = 8080
+    wss_deflate_level: int = 6
+    wss_deflate_window_bits: int = 12
+    rl_generation_sender: RateLimit = None
+    rl_generation_room: RateLimit = None
+    rl_edit_sender: RateLimit = None
+    rl_edit_room: RateLimit = None
+    rl_command_sender: RateLimit = None
+    rl_command_room: RateLimit = None
+    rl_notice_interval: float = 30.0
 
     @staticmethod
     def load_logger() -> logging.Logger:
@@ -35,7 +66,14 @@ class EnvConfig:
         mx_owner_id = os.getenv("MATRIX_OWNER_ID")
         mx_store_path = os.getenv("MATRIX_STORE_PATH", "./matrix_store")
         encryption_enabled = os.getenv("MATRIX_ENCRYPTION_ENABLED", "false").lower() == "true"
+        e2ee_prewarm = os.getenv("MATRIX_E2EE_PREWARM", "true").lower() == "true"
+        e2ee_warm_interval = float(os.getenv("MATRIX_E2EE_WARM_INTERVAL", 30))
+        segment_max_bytes = int(os.getenv("MATRIX_SEGMENT_MAX_BYTES", 48000))
+        traffic_record_path = os.getenv("TRAFFIC_RECORD_PATH") or None
         wss_port = int(os.getenv("WSS_PORT", 8080))
+        wss_deflate_level = int(os.getenv("WSS_DEFLATE_LEVEL", 6))
+        wss_deflate_window_bits = int(os.getenv("WSS_DEFLATE_WINDOW_BITS", 12))
+        rl_notice_interval = float(os.getenv("RATE_LIMIT_NOTICE_INTERVAL", 30))
 
         required = {
             "MATRIX_HOMESERVER": mx_homeserver,
@@ -58,5 +96,18 @@ class EnvConfig:
             mx_owner_id=mx_owner_id,
             mx_store_path=mx_store_path,
             mx_encryption_enabled=encryption_enabled,
+            mx_e2ee_prewarm=e2ee_prewarm,
+            mx_e2ee_warm_interval=e2ee_warm_interval,
+            mx_segment_max_bytes=segment_max_bytes,
+            traffic_record_path=traffic_record_path,
             wss_port=wss_port,
+            wss_deflate_level=wss_deflate_level,
+            wss_deflate_window_bits=wss_deflate_window_bits,
+            rl_generation_sender=_parse_rate_limit("RATE_LIMIT_GENERATION_SENDER"),
+            rl_generation_room=_parse_rate_limit("RATE_LIMIT_GENERATION_ROOM"),
+            rl_edit_sender=_parse_rate_limit("RATE_LIMIT_EDIT_SENDER"),
+            rl_edit_room=_parse_rate_limit("RATE_LIMIT_EDIT_ROOM"),
+            rl_command_sender=_parse_rate_limit("RATE_LIMIT_COMMAND_SENDER"),
+            rl_command_room=_parse_rate_limit("RATE_LIMIT_COMMAND_ROOM"),
+            rl_notice_interval=rl_notice_interval,
         )
@@ -35,6 +35,11 @@ let lastProcessedChatId = null; // 用于存储最后处理过的Telegram chatId
 // 添加一个全局变量来跟踪当前是否处于流式模式
 let isStreamingMode = false;
 
+// 与桥接服务器握手协商的编码与特性，每次连接时重置
+const SUPPORTED_CODECS = ['json'];
+const SUPPORTED_FEATURES = ['html_auto'];
+let bridgeFeatures = [];
+
 // --- 工具函数 ---
 function getSettings() {
     if (!extensionSettings[MODULE_NAME]) {
@@ -54,6 +59,29 @@ function updateStatus(message, color) {
 function reloadPage() {
     window.location.reload();
 }
+
+function sendFrame(payload) {
+    ws.send(JSON.stringify(payload));
+}
+
+// HTML 只包含段落与换行，且文字与纯文本一致时，桥接服务器可以自行渲染，无需发送
+function isTrivialHtml(text, html) {
+    const stripped = html.replace(/<\/?p>|<br\s*\/?>/gi, '\n');
+    if (/<[a-z!\/]/i.test(stripped)) {
+        return false;
+    }
+    const decoder = document.createElement('textarea');
+    decoder.innerHTML = stripped;
+    const normalize = (s) => s.replace(/\s+/g, ' ').trim();
+    return normalize(decoder.value) === normalize(text);
+}
+
+function htmlForBridge(text, html) {
+    if (html && bridgeFeatures.includes('html_auto') && isTrivialHtml(text, html)) {
+        return undefined;
+    }
+    return html;
+}
 // ---
 
 // 连接到WebSocket服务器
@@ -77,6 +105,9 @@ function connect() {
     ws.onopen = () => {
         console.log('[Telegram Bridge] 连接成功！');
         updateStatus('已连接', 'green');
+        // 能力握手
+        bridgeFeatures = [];
+        sendFrame({ type: 'hello', codecs: SUPPORTED_CODECS, features: SUPPORTED_FEATURES });
     };
 
     ws.onmessage = async (event) => {
@@ -84,6 +115,13 @@ function connect() {
         try {
             data = JSON.parse(event.data);
 
+            // --- 握手确认 ---
+            if (data.type === 'hello_ack') {
+                bridgeFeatures = data.features || [];
+                console.log(`[Telegram Bridge] 协商编码: ${data.codec}，特性: ${bridgeFeatures.join(', ')}`);
+                return;
+            }
+
             // --- 用户消息处理 ---
             if (data.type === 'user_message') {
                 console.log('[Telegram Bridge] 收到用户消息。', data);
@@ -96,7 +134,7 @@ function connect() {
 
                 // 1. 立即向Telegram发送“输入中”状态（无论是否流式）
                 if (ws && ws.readyState === WebSocket.OPEN) {
-                    ws.send(JSON.stringify({ type: 'typing_action', chatId: data.chatId }));
+                    sendFrame({ type: 'typing_action', chatId: data.chatId });
                 }
 
                 // 2. 将用户消息添加到SillyTavern
@@ -108,11 +146,11 @@ function connect() {
                     isStreamingMode = true;
                     // 将每个文本块通过WebSocket发送到服务端
                     if (ws && ws.readyState === WebSocket.OPEN) {
-                        ws.send(JSON.stringify({
+                        sendFrame({
                             type: 'stream_chunk',
                             chatId: data.chatId,
                             text: cumulativeText,
-                        }));
+                        });
                     }
                 };
                 eventSource.on(event_types.STREAM_TOKEN_RECEIVED, streamCallback);
@@ -123,7 +161,7 @@ function connect() {
                     if (ws && ws.readyState === WebSocket.OPEN && isStreamingMode) {
                         // 仅在没有错误且确实处于流式模式时发送stream_end
                         if (!data.error) {
-                            ws.send(JSON.stringify({ type: 'stream_end', chatId: data.chatId }));
+                            sendFrame({ type: 'stream_end', chatId: data.chatId });
                         }
                     }
                     // 注意：不在这里重置isStreamingMode，让handleFinalMessage函数来处理
@@ -150,11 +188,11 @@ function connect() {
                     // b. 准备并发送错误信息到服务端
                     const errorMessage = `抱歉，AI生成回复时遇到错误。\n您的上一条消息已被撤回，请重试或发送不同内容。\n\n错误详情: ${error.message || '未知错误'}`;
                     if (ws && ws.readyState === WebSocket.OPEN) {
-                        ws.send(JSON.stringify({
+                        sendFrame({
                             type: 'error_message',
                             chatId: data.chatId,
                             text: errorMessage,
-                        }));
+                        });
                     }
 
                     // c. 标记错误以便cleanup函数知道
@@ -165,6 +203,36 @@ function connect() {
                 return;
             }
 
+            // --- 聊天记录回填：按页返回当前聊天的消息 ---
+            if (data.type === 'backfill_request') {
+                console.log('[Telegram Bridge] 收到回填请求', data);
+
+                // 首页请求可以指定要加载的聊天记录
+                if (data.offset === 0 && data.chatName) {
+                    await openCharacterChat(data.chatName);
+                }
+
+                const context = SillyTavern.getContext();
+                const chat = context.chat || [];
+                const messages = chat.slice(data.offset, data.offset + data.limit).map(m => ({
+                    name: m.name,
+                    is_user: !!m.is_user,
+                    text: m.mes,
+                }));
+
+                if (ws && ws.readyState === WebSocket.OPEN) {
+                    sendFrame({
+                        type: 'backfill_page',
+                        chatId: data.chatId,
+                        chatName: typeof context.getCurrentChatId === 'function' ? context.getCurrentChatId() : data.chatName,
+                        offset: data.offset,
+                        total: chat.length,
+                        messages: messages,
+                    });
+                }
+                return;
+            }
+
             // --- 系统命令处理 ---
             if (data.type === 'system_command') {
                 console.log('[Telegram Bridge] 收到系统命令', data);
@@ -181,7 +249,7 @@ function connect() {
 
                 // 显示“输入中”状态
                 if (ws && ws.readyState === WebSocket.OPEN) {
-                    ws.send(JSON.stringify({ type: 'typing_action', chatId: data.chatId }));
+                    sendFrame({ type: 'typing_action', chatId: data.chatId });
                 }
 
                 let replyText = '命令执行失败，请稍后重试。';
@@ -320,15 +388,15 @@ function connect() {
                 // 发送命令执行结果
                 if (ws && ws.readyState === WebSocket.OPEN) {
                     // 发送命令执行结果到Telegram
-                    ws.send(JSON.stringify({ type: 'ai_reply', chatId: data.chatId, text: replyText }));
+                    sendFrame({ type: 'ai_reply', chatId: data.chatId, text: replyText });
 
                     // 发送命令执行状态反馈到服务器
-                    ws.send(JSON.stringify({
+                    sendFrame({
                         type: 'command_executed',
                         command: data.command,
                         success: commandSuccess,
                         message: replyText
-                    }));
+                    });
                 }
 
                 return;
@@ -336,7 +404,7 @@ function connect() {
         } catch (error) {
             console.error('[Telegram Bridge] 处理请求时发生错误：', error);
             if (data && data.chatId && ws && ws.readyState === WebSocket.OPEN) {
-                ws.send(JSON.stringify({ type: 'error_message', chatId: data.chatId, text: '处理您的请求时发生了一个内部错误。' }));
+                sendFrame({ type: 'error_message', chatId: data.chatId, text: '处理您的请求时发生了一个内部错误。' });
             }
         }
     };
@@ -436,22 +504,22 @@ function handleFinalMessage(lastMessageIdInChatArray) {
                 // 判断是流式还是非流式响应
                 if (isStreamingMode) {
                     // 流式响应 - 发送final_message_update
-                    ws.send(JSON.stringify({
+                    sendFrame({
                         type: 'final_message_update',
                         chatId: lastProcessedChatId,
                         text: renderedText,
-                        html: messageTextElement.html(),
-                    }));
+                        html: htmlForBridge(renderedText, messageTextElement.html()),
+                    });
                     // 重置流式模式标志
                     isStreamingMode = false;
                 } else {
                     // 非流式响应 - 直接发送ai_reply
-                    ws.send(JSON.stringify({
+                    sendFrame({
                         type: 'ai_reply',
                         chatId: lastProcessedChatId,
                         text: renderedText,
-                        html: messageTextElement.html(),
-                    }));
+                        html: htmlForBridge(renderedText, messageTextElement.html()),
+                    });
                 }
 
                 // 重置chatId，避免意外更新其他用户的消息
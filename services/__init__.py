@@ -1,3 +1,6 @@
 from .matrix_client import MatrixClient
 from .sillytavern_server import SillyTavernServer
 from .event_tracker import EventTracker
+from .admission_control import AdmissionController
+from .search_index import SearchIndex
+from .traffic_recorder import TrafficRecorder
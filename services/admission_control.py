@@ -0,0 +1,60 @@
+import time
+from typing import Dict, Tuple
+
+from utils import SingletonMixin, TokenBucketLimiter
+
+# 需要分别限流的请求类型
+GENERATION = "generation"
+EDIT = "edit"
+COMMAND = "command"
+
+
+class AdmissionController(SingletonMixin):
+    """按发送者和房间限流，超限的事件直接丢弃，并按房间限频发送一次提示。"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        specs = {
+            GENERATION: (self.cfg.rl_generation_sender, self.cfg.rl_generation_room),
+            EDIT: (self.cfg.rl_edit_sender, self.cfg.rl_edit_room),
+            COMMAND: (self.cfg.rl_command_sender, self.cfg.rl_command_room),
+        }
+        # {kind: (per_sender, per_room)}，未配置的限流器为 None
+        self.limiters: Dict[str, Tuple[TokenBucketLimiter | None, TokenBucketLimiter | None]] = {
+            kind: tuple(TokenBucketLimiter(*spec) if spec else None for spec in pair)
+            for kind, pair in specs.items()
+        }
+        self.notice_interval = self.cfg.rl_notice_interval
+        self._last_notice: Dict[str, float] = {}
+        self.shed_count = 0
+
+    def admit(self, kind: str, sender: str, room_id: str) -> bool:
+        sender_limiter, room_limiter = self.limiters[kind]
+        if sender_limiter is None and room_limiter is None:
+            return True
+
+        now = time.monotonic()
+        # 两个桶都有余量时才同时扣减，避免被拒绝的事件白白消耗另一个桶
+        if sender_limiter is not None and sender_limiter.peek(sender, now) < 1:
+            return self._shed(kind, sender, room_id)
+        if room_limiter is not None and room_limiter.peek(room_id, now) < 1:
+            return self._shed(kind, sender, room_id)
+        if sender_limiter is not None:
+            sender_limiter.consume(sender)
+        if room_limiter is not None:
+            room_limiter.consume(room_id)
+        return True
+
+    def should_notify(self, room_id: str) -> bool:
+        """同一房间在 notice_interval 秒内只提示一次。"""
+        now = time.monotonic()
+        last = self._last_notice.get(room_id)
+        if last is not None and now - last < self.notice_interval:
+            return False
+        self._last_notice[room_id] = now
+        return True
+
+    def _shed(self, kind: str, sender: str, room_id: str) -> bool:
+        self.shed_count += 1
+        self.logger.info(f"Shedding {kind} event from {sender} in {room_id} (total shed: {self.shed_count})")
+        return False
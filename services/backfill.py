@@ -0,0 +1,157 @@
+from __future__ import annotations
+
+import asyncio
+import html
+import time
+from typing import TYPE_CHECKING, Any, Dict, List, Tuple
+
+if TYPE_CHECKING:
+    from .sillytavern_server import SillyTavernServer
+
+
+class BackfillSession:
+    """把 SillyTavern 中已有的聊天记录分页拉取并回填到新的 Matrix 线程。
+
+    每次只向扩展请求一页，并在发送当前页时预取下一页，
+    因此内存中最多同时存在两页消息。
+    """
+
+    def __init__(
+        self,
+        server: SillyTavernServer,
+        room_id: str,
+        chat_id: str,
+        chat_name: str = "",
+        page_size: int = 50,
+        page_timeout: float = 60.0,
+    ):
+        self.server = server
+        self.room_id = room_id
+        self.chat_id = chat_id
+        self.chat_name = chat_name
+        self.page_size = page_size
+        self.page_timeout = page_timeout
+        self.logger = server.logger
+        self.pages: asyncio.Queue[Dict[str, Any]] = asyncio.Queue(maxsize=2)
+        self.thread_id: str | None = None
+        self.progress_event_id: str | None = None
+        self.posted = 0
+        self.total = 0
+        self.error: str | None = None
+        self.task: asyncio.Task | None = None
+
+    async def feed(self, data: Dict[str, Any]) -> None:
+        """由 SillyTavernServer 在收到 backfill_page 时调用。"""
+        await self.pages.put(data)
+
+    async def abort(self, reason: str) -> None:
+        self.error = reason
+        await self.pages.put({})
+
+    async def run(self) -> None:
+        matrix_client = self.server.matrix_client
+        event_tracker = self.server.event_tracker
+        event_ids: List[str] = []
+        started = time.monotonic()
+        try:
+            await self._request(0)
+            offset = 0
+            while True:
+                page = await asyncio.wait_for(self.pages.get(), self.page_timeout)
+                if self.error is not None:
+                    break
+
+                messages = page.get("messages", [])
+                self.total = int(page.get("total", 0))
+                next_offset = int(page.get("offset", offset)) + len(messages)
+                # 先请求下一页，让扩展读取与 Matrix 发送并行
+                if messages and next_offset < self.total:
+                    await self._request(next_offset)
+
+                if self.thread_id is None:
+                    if not messages and self.total == 0:
+                        # 空聊天不创建线程，避免留下一个空的已知线程
+                        break
+                    await self._open_thread(page.get("chatName") or self.chat_name)
+
+                sent = await matrix_client.send_texts(
+                    self.room_id, self.thread_id, [self._format(m) for m in messages]
+                )
+                event_ids.extend(sent)
+                self.posted += len(sent)
+                if len(sent) < len(messages):
+                    # 跳过失败的消息会让 EventTracker 与 SillyTavern 聊天记录错位
+                    self.error = f"第 {self.posted + 1} 条消息发送失败。"
+                    break
+                offset = next_offset
+                await self._report(started, done=False)
+
+                if not messages or offset >= self.total:
+                    break
+        except asyncio.TimeoutError:
+            self.error = "等待 SillyTavern 返回聊天记录超时。"
+        except ConnectionError as e:
+            self.error = str(e)
+        except Exception as e:
+            self.logger.exception("Backfill failed")
+            self.error = str(e)
+        finally:
+            # 所有回填事件一次性写入 EventTracker
+            event_tracker.track_event_ids(self.thread_id, event_ids)
+            if self.error is not None and self.thread_id is not None and self.server.thread_id == self.thread_id:
+                # 不完整的线程与 SillyTavern 聊天记录对不上，与 !switchchat 一样，下一条消息开启新会话
+                self.server.thread_id = None
+            await self._report(started, done=True)
+
+    async def _request(self, offset: int) -> None:
+        payload: Dict[str, Any] = {
+            "type": "backfill_request",
+            "chatId": self.chat_id,
+            "offset": offset,
+            "limit": self.page_size,
+        }
+        if offset == 0 and self.chat_name:
+            payload["chatName"] = self.chat_name
+        # 回填期间扩展可能断开，此时 server.server 为 None
+        if not (self.server.server and self.server.server.state == 1):
+            raise ConnectionError("SillyTavern 连接已断开。")
+        await self.server.send(payload)
+
+    async def _open_thread(self, chat_name: str) -> None:
+        matrix_client = self.server.matrix_client
+        self.thread_id = await matrix_client.send_text(f"聊天记录回填：{chat_name}", self.room_id)
+        self.server.event_tracker.register_thread(self.thread_id, chat_name)
+        # 之后在该线程中的对话继续接在回填的聊天记录之后
+        self.server.thread_id = self.thread_id
+
+    async def _report(self, started: float, done: bool) -> None:
+        matrix_client = self.server.matrix_client
+        elapsed = max(time.monotonic() - started, 1e-6)
+        rate = self.posted / elapsed
+        if self.error is not None:
+            text = f"回填中断：{self.error}\n已回填 {self.posted}/{self.total} 条消息。"
+            if self.thread_id is not None:
+                text += f"\n该线程不完整，请使用 !removethread {self.thread_id} 删除后重新回填。"
+        elif done and self.thread_id is None:
+            text = "聊天记录为空，无需回填。"
+        elif done:
+            text = f"回填完成：共 {self.posted} 条消息，用时 {elapsed:.1f} 秒，平均 {rate:.1f} 条/秒。"
+        else:
+            text = f"回填进度：{self.posted}/{self.total} 条消息，{rate:.1f} 条/秒。"
+
+        if self.progress_event_id:
+            await matrix_client.edit_text(text, self.room_id, self.progress_event_id)
+        else:
+            # 进度消息发在线程外，避免插入到回填的聊天记录中间
+            self.progress_event_id = await matrix_client.send_text(text, self.room_id)
+            self.server.event_tracker.track_trash_event_id(self.progress_event_id)
+        if done:
+            self.logger.info(text)
+
+    @staticmethod
+    def _format(message: Dict[str, Any]) -> Tuple[str, str]:
+        name = message.get("name") or ("User" if message.get("is_user") else "AI")
+        text = str(message.get("text", "")).rstrip("\n")
+        body = f"{name}: {text}"
+        formatted = f"<b>{html.escape(name)}</b>: {html.escape(text).replace(chr(10), '<br>')}"
+        return body, formatted
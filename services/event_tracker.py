@@ -1,7 +1,9 @@
 from collections import deque
 import json
 import logging
+import math
 import os
+import time
 from typing import Set, Tuple
 
 from .matrix_client import MatrixClient
@@ -17,8 +19,12 @@ class EventTracker(SingletonMixin):
         self.tracked_events: Set[str] = set()
         self.trash_events: Set[str] = set()
         self.ordered_events: deque[Tuple[str, str]] = deque()
+        # 长回复被切分后的后续段：{首段 event_id: [后续段 event_id]}，删除首段时一并删除
+        self.segments: dict[str, list[str]] = {}
         # 记录每个线程的首条用户消息文本：{thread_id: first_text}
         self.thread: dict[str, str] = {}
+        # 每个线程最近一次活动的时间戳，用于按最近使用排序
+        self.thread_activity: dict[str, float] = {}
         self._storage_path = os.path.join(self.cfg.mx_store_path, "event_tracker.json")
         self._load_state()
 
@@ -39,12 +45,17 @@ class EventTracker(SingletonMixin):
             else:
                 self.tracked_events = set(e for _, e in self.ordered_events)
 
+            segment_map = data.get("segments", {})
+            self.segments = {str(h): [str(e) for e in ids] for h, ids in segment_map.items()}
+
             trash_list = data.get("trash_events", [])
             self.trash_events = set(str(e) for e in trash_list)
 
             thread_meta = data.get("thread", {}) or data.get("thread_first_text", {})
             # 保持插入顺序，便于按创建顺序列出
             self.thread = {str(tid): str(txt) for tid, txt in thread_meta.items()}
+            activity = data.get("thread_activity", {})
+            self.thread_activity = {str(tid): float(ts) for tid, ts in activity.items()}
         except Exception as e:
             self.logger.error(f"Failed to load event tracker state: {e}")
 
@@ -55,7 +66,9 @@ class EventTracker(SingletonMixin):
                 "ordered_events": list(self.ordered_events),
                 "tracked_events": list(self.tracked_events),
                 "trash_events": list(self.trash_events),
+                "segments": self.segments,
                 "thread": self.thread,
+                "thread_activity": self.thread_activity,
             }
             with open(self._storage_path, "w", encoding="utf-8") as f:
                 json.dump(data, f, ensure_ascii=False)
@@ -74,16 +87,37 @@ class EventTracker(SingletonMixin):
             return
 
         self.thread[thread_id] = first_text
+        self.thread_activity[thread_id] = time.time()
+        self._save_state()
+
+    def remove_thread(self, thread_id: str) -> None:
+        self.thread.pop(thread_id, None)
+        self.thread_activity.pop(thread_id, None)
         self._save_state()
 
-    def list_threads_markdown(self) -> str:
-        """以 markdown+序号 的形式列出所有已知线程（id + first text）。"""
+    def list_threads_markdown(self, page: int = 1, page_size: int = 10) -> str:
+        """以 markdown+序号 的形式分页列出已知线程（id + first text），最近活跃的在前。"""
         if not self.thread:
             return "暂无会话线程。"
 
+        # 没有活动记录的旧线程按创建顺序排在最后
+        order = {thread_id: i for i, thread_id in enumerate(self.thread)}
+        thread_ids = sorted(
+            self.thread,
+            key=lambda t: (self.thread_activity.get(t, 0.0), order[t]),
+            reverse=True,
+        )
+        pages = math.ceil(len(thread_ids) / page_size)
+        page = min(max(page, 1), pages)
+        start = (page - 1) * page_size
+
         lines: list[str] = []
-        for idx, (thread_id, first_text) in enumerate(self.thread.items(), start=1):
+        for idx, thread_id in enumerate(thread_ids[start:start + page_size], start=start + 1):
+            first_text = self.thread[thread_id]
             lines.append(f"{idx}.\nthread_id:\n{thread_id}\nfirst_text:\n{first_text}\n\n\n")
+        lines.append(f"第 {page}/{pages} 页，共 {len(thread_ids)} 个线程")
+        if page < pages:
+            lines.append(f"使用 !listthreads {page + 1} 查看下一页")
 
         return "\n".join(lines)
 
@@ -98,6 +132,40 @@ class EventTracker(SingletonMixin):
 
         self.tracked_events.add(event_id)
         self.ordered_events.append((thread_id, event_id))
+        self._touch_thread(thread_id)
+        self._save_state()
+
+    def track_event_ids(self, thread_id: str | None, event_ids: list[str]) -> None:
+        """批量记录事件，只写一次状态文件。"""
+        if thread_id is None:
+            return
+        added = False
+        for event_id in event_ids:
+            if not event_id or self.has_tracked(event_id):
+                continue
+            self.tracked_events.add(event_id)
+            self.ordered_events.append((thread_id, event_id))
+            added = True
+        if added:
+            self._touch_thread(thread_id)
+            self._save_state()
+
+    def _touch_thread(self, thread_id: str) -> None:
+        if thread_id in self.thread:
+            self.thread_activity[thread_id] = time.time()
+
+    def track_segment_event_ids(self, head_event_id: str | None, event_ids: list[str]) -> None:
+        """记录属于同一条回复的后续段，它们不单独计入 ordered_events，以免影响删除计数。"""
+        if not head_event_id:
+            return
+        event_ids = [e for e in event_ids if e and e != head_event_id]
+        if self.segments.get(head_event_id, []) == event_ids:
+            return
+        if event_ids:
+            self.segments[head_event_id] = event_ids
+        else:
+            self.segments.pop(head_event_id, None)
+        self.tracked_events.update(event_ids)
         self._save_state()
 
     def track_trash_event_id(self, event_id: str | None):
@@ -148,12 +216,14 @@ class EventTracker(SingletonMixin):
                 if t_id == thread_id:
                     events_to_delete.append(e_id)
 
-            # Delete them
+            # Delete them, including the continuation segments of long replies
             for e_id in events_to_delete:
-                try:
-                    await self.matrix_client.delete_text(room_id, e_id)
-                except Exception as e:
-                    self.logger.error(f"Failed to delete event {e_id}: {e}")
+                for seg_id in [e_id, *self.segments.pop(e_id, [])]:
+                    try:
+                        await self.matrix_client.delete_text(room_id, seg_id)
+                    except Exception as e:
+                        self.logger.error(f"Failed to delete event {seg_id}: {e}")
+                    self.tracked_events.discard(seg_id)
 
             # Remove from tracking
             self.ordered_events = deque(
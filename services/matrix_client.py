@@ -2,9 +2,10 @@ from __future__ import annotations
 
 import asyncio
 import mimetypes
+import time
 from dataclasses import dataclass, field
 from io import BytesIO
-from typing import Any, Dict
+from typing import Any, Dict, List, Tuple
 from niobot import NioBot, UploadResponse
 
 from utils import SingletonMixin
@@ -34,15 +35,23 @@ class MatrixClient(SingletonMixin):
         super().__init__(*args, **kwargs)
         self.bot = bot
         self.matrix_loop = asyncio.new_event_loop()
+        # 最近有对话的加密房间，后台保持其设备列表与出站 Megolm 会话就绪
+        self.warm_rooms: set[str] = set()
+        self._prewarm_enabled = self.cfg.mx_encryption_enabled and self.cfg.mx_e2ee_prewarm
+        self._warm_task: asyncio.Task | None = None
 
     def login(self):
         """Run the Matrix NioBot in its own thread."""
         asyncio.set_event_loop(self.matrix_loop)
+        if self._prewarm_enabled:
+            self._warm_task = self.matrix_loop.create_task(self._keep_sessions_warm())
         try:
             self.matrix_loop.run_until_complete(self.bot.start(password=self.cfg.mx_password))
         except Exception:
             self.logger.exception("Matrix bot crashed")
         finally:
+            if self._warm_task is not None:
+                self._warm_task.cancel()
             try:
                 if not self.matrix_loop.is_closed():
                     self.matrix_loop.run_until_complete(self.bot.close())
@@ -71,11 +80,81 @@ class MatrixClient(SingletonMixin):
         future = asyncio.run_coroutine_threadsafe(coro, self.matrix_loop)
         return await asyncio.wrap_future(future)
 
+    def schedule_prewarm(self, room_id: str | None) -> None:
+        """在 Matrix 线程中后台预热房间的加密会话，不等待完成。
+
+        在向 SillyTavern 派发 user_message 后调用，使设备查询与 Megolm 会话分享
+        与 LLM 生成并行进行，而不是阻塞在回复的第一次 room_send 上。
+        """
+        if not self._prewarm_enabled or room_id is None:
+            return
+        self.warm_rooms.add(room_id)
+        if self.matrix_loop.is_running():
+            asyncio.run_coroutine_threadsafe(self._prewarm_room(room_id), self.matrix_loop)
+
+    async def _prewarm_room(self, room_id: str) -> None:
+        room = self.bot.rooms.get(room_id)
+        if room is None or not room.encrypted:
+            return
+        started = time.perf_counter()
+        try:
+            # 设备查询由 nio 的 sync_forever 每轮发起，nio 没有“查询中”的标记，
+            # 这里再查一次只会与之并发重复请求；等它完成后再分享，会话才包含新设备
+            if not await self._wait_for_keys_query():
+                return
+            # nio 在分享会话时会登记到 sharing_session，room_send 会等待而不是重复分享
+            if room_id in self.bot.sharing_session:
+                return
+            if self.bot.olm.should_share_group_session(room_id):
+                await self.bot.share_group_session(room_id, ignore_unverified_devices=True)
+                self.logger.info(
+                    f"Pre-shared Megolm session for {room_id} in {(time.perf_counter() - started) * 1000:.0f}ms"
+                )
+        except Exception as e:
+            self.logger.warning(f"Failed to prewarm encryption for {room_id}: {e}")
+
+    async def _wait_for_keys_query(self, timeout: float = 10.0) -> bool:
+        """等待同步循环完成待进行的设备查询；超时返回 False，交给下一次预热。"""
+        deadline = time.monotonic() + timeout
+        while self.bot.should_query_keys:
+            if time.monotonic() >= deadline:
+                return False
+            await asyncio.sleep(0.1)
+        return True
+
+    async def _keep_sessions_warm(self) -> None:
+        """定期为活跃的加密房间刷新设备列表，并在成员或设备变化后提前分享会话。"""
+        while True:
+            await asyncio.sleep(self.cfg.mx_e2ee_warm_interval)
+            for room_id in list(self.warm_rooms):
+                await self._prewarm_room(room_id)
+
     async def send_text(self, text: str, room_id: str | None, thread_id: str | None = None, html: str | None = None) -> str | None:
         if room_id is not None:
             return await self._run_in_matrix_loop(self._send_text(text, room_id, thread_id, html))
 
     async def _send_text(self, text: str, room_id: str, thread_id: str | None = None, html: str | None = None) -> str:
+        started = time.perf_counter()
+        response = await self.bot.room_send(
+            room_id=room_id,
+            message_type="m.room.message",
+            content=self._text_content(text, thread_id, html),
+            ignore_unverified_devices=self.cfg.mx_encryption_enabled,
+        )
+        if self.cfg.mx_encryption_enabled:
+            self.logger.debug(f"room_send to {room_id} took {(time.perf_counter() - started) * 1000:.0f}ms")
+
+        return getattr(response, "event_id", "")
+
+    def is_encrypted(self, room_id: str | None) -> bool:
+        """房间是否加密；尚未同步到的房间在开启加密时按加密处理。"""
+        room = self.bot.rooms.get(room_id) if room_id else None
+        if room is None:
+            return self.cfg.mx_encryption_enabled
+        return bool(room.encrypted)
+
+    @staticmethod
+    def _text_content(text: str, thread_id: str | None = None, html: str | None = None) -> Dict[str, Any]:
         content = {
             "msgtype": "m.text",
             "body": text,
@@ -91,22 +170,72 @@ class MatrixClient(SingletonMixin):
                     "event_id": thread_id
                 },
             }
+        return content
 
-        response = await self.bot.room_send(
-            room_id=room_id,
-            message_type="m.room.message",
-            content=content,
-            ignore_unverified_devices=self.cfg.mx_encryption_enabled,
-        )
+    async def send_texts(
+        self, room_id: str | None, thread_id: str | None, messages: List[Tuple[str, str | None]], max_retries: int = 5
+    ) -> List[str]:
+        """按顺序批量发送 (text, html) 消息，返回已发送的 event_id 列表。
 
-        return getattr(response, "event_id", "")
+        某条消息重试后仍发送失败时立即停止，返回的列表会短于 messages，
+        之后的消息都不会发送，以免线程中的消息出现缺口。
+        """
+        if room_id is not None:
+            return await self._run_in_matrix_loop(self._send_texts(room_id, thread_id, messages, max_retries))
+        return []
+
+    async def _send_texts(
+        self, room_id: str, thread_id: str | None, messages: List[Tuple[str, str | None]], max_retries: int
+    ) -> List[str]:
+        event_ids: List[str] = []
+        for text, html in messages:
+            content = self._text_content(text, thread_id, html)
+            for _ in range(max_retries + 1):
+                response = await self.bot.room_send(
+                    room_id=room_id,
+                    message_type="m.room.message",
+                    content=content,
+                    ignore_unverified_devices=self.cfg.mx_encryption_enabled,
+                )
+                # 被服务器限流时按 retry_after_ms 等待后重试
+                retry_after_ms = getattr(response, "retry_after_ms", None)
+                if not retry_after_ms:
+                    break
+                self.logger.warning(f"Rate limited by homeserver, retrying in {retry_after_ms}ms")
+                await asyncio.sleep(retry_after_ms / 1000)
+            event_id = getattr(response, "event_id", None)
+            if not event_id:
+                self.logger.error(f"Failed to send message {len(event_ids) + 1}/{len(messages)}: {response}")
+                break
+            event_ids.append(event_id)
+        return event_ids
 
     async def edit_text(self, text: str, room_id: str | None, event_id: str, html: str | None = None) -> str | None:
         if room_id is not None:
             return await self._run_in_matrix_loop(self._edit_text(text, room_id, event_id, html))
 
+    @staticmethod
+    def _edit_content(text: str, event_id: str, html: str | None = None) -> Dict[str, Any]:
+        """m.replace 编辑事件：m.new_content 为新内容，外层 body/formatted_body 是不支持编辑的客户端的回退。"""
+        new_content = MatrixClient._text_content(text, html=html)
+        return {
+            **new_content,
+            "body": f"* {new_content['body']}",
+            "m.new_content": new_content,
+            "m.relates_to": {
+                "rel_type": "m.replace",
+                "event_id": event_id,
+            },
+        }
+
     async def _edit_text(self, text: str, room_id: str, event_id: str, html: str | None = None) -> str:
-        response = await self.bot.edit_message(room=room_id, message=event_id, content=html if html else text)
+        # 自行构造编辑内容而不是交给 NioBot.edit_message，事件大小与 segmenter 的估算保持一致
+        response = await self.bot.room_send(
+            room_id=room_id,
+            message_type="m.room.message",
+            content=self._edit_content(text, event_id, html),
+            ignore_unverified_devices=self.cfg.mx_encryption_enabled,
+        )
 
         return getattr(response, "event_id", "")
 
@@ -0,0 +1,553 @@
+import bisect
+import heapq
+import json
+import marshal
+import math
+import os
+import re
+import struct
+import threading
+import time
+from array import array
+from typing import Any, Callable, Dict, List, NamedTuple, Tuple
+
+from utils import SingletonMixin
+
+_LATIN_RE = re.compile(r"[0-9a-z]+")
+_CJK_RE = re.compile(r"[぀-ヿ㐀-䶿一-鿿가-힯]+")
+
+
+def tokenize(text: str) -> List[str]:
+    """索引用的切词：英文数字按词切分，中日韩文字同时保留单字与相邻二字，单字查询也能命中。"""
+    text = text.lower()
+    tokens = _LATIN_RE.findall(text)
+    for run in _CJK_RE.findall(text):
+        tokens.extend(run)
+        tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return tokens
+
+
+def query_terms(query: str) -> List[str]:
+    """查询用的切词：多字串只取相邻二字，单字串取单字，避免常用单字稀释多字查询的排序。"""
+    query = query.lower()
+    terms = _LATIN_RE.findall(query)
+    for run in _CJK_RE.findall(query):
+        if len(run) == 1:
+            terms.append(run)
+        else:
+            terms.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return list(dict.fromkeys(terms))
+
+
+class SearchHit(NamedTuple):
+    score: float
+    room_id: str
+    thread_id: str
+    event_id: str
+    role: str
+    timestamp: float
+    snippet: str
+
+
+class SearchResults(NamedTuple):
+    total: int
+    hits: List[SearchHit]
+    # 高频词提前终止时，total 是抽样估算的结果数
+    approximate: bool = False
+    # 遍历达到 WALK_LIMIT 仍未确认前几名时，排序只是近似的
+    ranked_approximately: bool = False
+
+
+# (doc ids, term frequencies)，doc id 单调递增
+Posting = Tuple[array, array]
+
+
+class SearchIndex(SingletonMixin):
+    """已桥接的用户与 AI 发言的增量倒排索引，按房间分别建立。
+
+    发言追加写入 mx_store_path 下的 JSONL 日志，并定期把倒排表整体写成快照，
+    启动时读取快照后只需重放快照之后追加的日志。
+    """
+
+    SNIPPET_LEN = 80
+    K1 = 1.2
+    B = 0.75
+    # 最短倒排表不超过该长度时，对所有同时包含各词的文档精确打分
+    EXACT_MAX_DF = 4000
+    # 高频词凑满当前页后按影响力顺序遍历的最大层数，正常查询远未走到即可确认前几名，仅作为耗时上限
+    WALK_LIMIT = 20000
+    # 提前终止时估算结果总数的抽样数
+    ESTIMATE_SAMPLES = 256
+    # 每新增这么多条发言重写一次快照
+    SNAPSHOT_EVERY = 2000
+    SNAPSHOT_VERSION = 4
+    # 快照分块序列化，每块一次 marshal 调用，避免后台写入长时间占用 GIL
+    SNAPSHOT_CHUNK = 10000
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._storage_path = os.path.join(self.cfg.mx_store_path, "search_index.jsonl")
+        self._snapshot_path = os.path.join(self.cfg.mx_store_path, "search_index.snapshot")
+        # 文档元数据：(room_id, thread_id, event_id, role, timestamp, snippet)
+        self.docs: List[Tuple[str, str, str, str, float, str]] = []
+        self.doc_lengths = array("I")
+        self.total_length = 0
+        # {room_id: {token: posting}}
+        self.postings: Dict[str, Dict[str, Posting]] = {}
+        # 快照中的倒排表按房间拼接存放：{room_id: ({token: (start, end)}, doc ids, term frequencies)}，
+        # 首次访问某个词时才切出独立的 posting，避免启动时创建数十万个数组
+        self._frozen: Dict[str, Tuple[Dict[str, Tuple[int, int]], array, array]] = {}
+        self.room_sizes: Dict[str, int] = {}
+        self.event_ids: set[str] = set()
+        # 高频词的影响力顺序：{(room_id, token): (排序时的倒排表长度, 按影响力降序的下标)}
+        self._impacts: Dict[Tuple[str, str], Tuple[int, array]] = {}
+        # 已纳入内存索引的日志字节数，写入快照以便启动时从此处继续重放
+        self._log_offset = 0
+        self._unsaved = 0
+        self._snapshot_lock = threading.Lock()
+        # add 分别在 Matrix 线程（用户发言）与 WebSocket 线程（AI 回复）中调用，
+        # 分配 doc id、写日志、记录快照截止点与查询都在这把锁下进行
+        self._index_lock = threading.Lock()
+        self._load_state()
+
+    def _load_state(self) -> None:
+        started = time.perf_counter()
+        try:
+            offset = self._load_snapshot()
+            replayed = self._replay_log(offset)
+        except Exception as e:
+            self.logger.error(f"Failed to load search index: {e}")
+            return
+        self.logger.info(
+            f"Loaded {len(self.docs)} turns into search index ({replayed} replayed from log) "
+            f"in {(time.perf_counter() - started) * 1000:.0f}ms"
+        )
+        if replayed >= self.SNAPSHOT_EVERY:
+            with self._index_lock:
+                self._save_snapshot()
+
+    def _load_snapshot(self) -> int:
+        """读取快照并返回它覆盖的日志字节数；快照缺失、过期或损坏时返回 0，从头重放日志。"""
+        if not os.path.isfile(self._snapshot_path) or not os.path.isfile(self._storage_path):
+            return 0
+        try:
+            with open(self._snapshot_path, "rb") as f:
+                # 整体读入后再逐块反序列化，比 marshal.load 逐段读取文件快得多
+                blobs = self._unframe(f.read())
+            data = marshal.loads(next(blobs))
+            if (
+                data.get("version") != self.SNAPSHOT_VERSION
+                or data.get("itemsize") != array("I").itemsize
+                or data["log_offset"] > os.path.getsize(self._storage_path)
+            ):
+                return 0
+            docs: List[Tuple[str, str, str, str, str]] = []
+            for _ in range(data["doc_chunks"]):
+                docs.extend(tuple(doc) for doc in marshal.loads(next(blobs)))
+            doc_lengths = array("I")
+            doc_lengths.frombytes(next(blobs))
+            frozen: Dict[str, Tuple[Dict[str, Tuple[int, int]], array, array]] = {}
+            for room_id in data["rooms"]:
+                spans = marshal.loads(next(blobs))
+                doc_ids, freqs = array("I"), array("I")
+                doc_ids.frombytes(next(blobs))
+                freqs.frombytes(next(blobs))
+                frozen[room_id] = (spans, doc_ids, freqs)
+            impacts: Dict[Tuple[str, str], Tuple[int, array]] = {}
+            for (room_id, token), (sorted_n, order) in marshal.loads(next(blobs)):
+                positions = array("I")
+                positions.frombytes(order)
+                impacts[(room_id, token)] = (sorted_n, positions)
+        except Exception as e:
+            self.logger.warning(f"Ignoring unreadable search index snapshot: {e}")
+            return 0
+
+        self.docs = docs
+        self.doc_lengths = doc_lengths
+        self.total_length = data["total_length"]
+        self.postings = {room_id: {} for room_id in frozen}
+        self._frozen = frozen
+        self.room_sizes = data["room_sizes"]
+        self._impacts = impacts
+        self.event_ids = {doc[2] for doc in docs}
+        return data["log_offset"]
+
+    def _replay_log(self, offset: int) -> int:
+        if not os.path.isfile(self._storage_path):
+            return 0
+        replayed = 0
+        with open(self._storage_path, "rb") as f:
+            f.seek(offset)
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # 崩溃时写了一半的行
+                    continue
+                self._index(*record)
+                replayed += 1
+            self._log_offset = f.tell()
+        return replayed
+
+    def _save_snapshot(self) -> None:
+        """在后台线程中序列化并写入快照，不阻塞事件循环。
+
+        调用方需持有 _index_lock。截止点（文档数与日志偏移）在锁内记录，之后新增的文档 id
+        都不小于截止点，后台线程只取各倒排表中截止点之前的前缀，因此写入期间无需持锁。
+        """
+        if not self._snapshot_lock.acquire(blocking=False):
+            return
+        cutoff = {
+            "n_docs": len(self.docs),
+            "log_offset": self._log_offset,
+            "total_length": self.total_length,
+            "room_sizes": dict(self.room_sizes),
+        }
+        self._unsaved = 0
+        threading.Thread(target=self._write_snapshot, args=(cutoff,), daemon=True).start()
+
+    @staticmethod
+    def _write_frame(f, blob: bytes) -> None:
+        f.write(struct.pack("<Q", len(blob)))
+        f.write(blob)
+
+    @staticmethod
+    def _unframe(data: bytes):
+        view = memoryview(data)
+        offset = 0
+        while offset < len(view):
+            (size,) = struct.unpack_from("<Q", view, offset)
+            offset += 8
+            yield view[offset:offset + size]
+            offset += size
+
+    def _write_snapshot(self, cutoff: Dict[str, Any]) -> None:
+        n_docs = cutoff["n_docs"]
+        tmp_path = self._snapshot_path + ".tmp"
+        try:
+            postings = {}
+            lengths: Dict[Tuple[str, str], int] = {}
+            for room_id in list(self.postings):
+                spans, ids, tfs = self._pack_room(room_id, n_docs)
+                if spans:
+                    postings[room_id] = (spans, ids, tfs)
+                    lengths.update(((room_id, token), end - start) for token, (start, end) in spans.items())
+            docs = self.docs[:n_docs]
+            doc_chunks = [docs[i:i + self.SNAPSHOT_CHUNK] for i in range(0, len(docs), self.SNAPSHOT_CHUNK)]
+            header = {
+                "version": self.SNAPSHOT_VERSION,
+                "itemsize": self.doc_lengths.itemsize,
+                "log_offset": cutoff["log_offset"],
+                "doc_chunks": len(doc_chunks),
+                "total_length": cutoff["total_length"],
+                "room_sizes": cutoff["room_sizes"],
+                "rooms": list(postings),
+            }
+            with open(tmp_path, "wb") as f:
+                self._write_frame(f, marshal.dumps(header))
+                for chunk in doc_chunks:
+                    self._write_frame(f, marshal.dumps(chunk))
+                self._write_frame(f, self.doc_lengths[:n_docs].tobytes())
+                for spans, ids, tfs in postings.values():
+                    self._write_frame(f, marshal.dumps(spans))
+                    self._write_frame(f, ids)
+                    self._write_frame(f, tfs)
+                # 已排好的影响力顺序一并保存，重启后高频词的首次查询不必重新排序
+                self._write_frame(f, marshal.dumps([
+                    (key, (sorted_n, order.tobytes()))
+                    for key, (sorted_n, order) in list(self._impacts.items())
+                    if sorted_n <= lengths.get(key, 0)
+                ]))
+            os.replace(tmp_path, self._snapshot_path)
+        except Exception as e:
+            self.logger.error(f"Failed to save search index snapshot: {e}")
+        finally:
+            self._snapshot_lock.release()
+
+    def _pack_room(self, room_id: str, n_docs: int) -> Tuple[Dict[str, Tuple[int, int]], bytes, bytes]:
+        """把房间内各倒排表中 doc id 小于 n_docs 的前缀拼接为两个连续数组。"""
+        spans: Dict[str, Tuple[int, int]] = {}
+        ids_all, tfs_all = array("I"), array("I")
+        # 截止点之前有过追加的词，在截止点之前就已从快照中切出，复制出的字典里一定有它
+        materialized = dict(self.postings[room_id])
+        frozen_spans, frozen_ids, frozen_tfs = self._frozen.get(room_id, ({}, array("I"), array("I")))
+        for token, (start, end) in frozen_spans.items():
+            if token not in materialized:
+                spans[token] = (len(ids_all), len(ids_all) + end - start)
+                ids_all.extend(frozen_ids[start:end])
+                tfs_all.extend(frozen_tfs[start:end])
+        for token, (ids, tfs) in materialized.items():
+            n = bisect.bisect_left(ids, n_docs)
+            if n:
+                spans[token] = (len(ids_all), len(ids_all) + n)
+                ids_all.extend(ids[:n])
+                tfs_all.extend(tfs[:n])
+        return spans, ids_all.tobytes(), tfs_all.tobytes()
+
+    def _posting(self, room_id: str, token: str, create: bool = False) -> Posting | None:
+        room_postings = self.postings.get(room_id)
+        if room_postings is None:
+            if not create:
+                return None
+            room_postings = self.postings[room_id] = {}
+        posting = room_postings.get(token)
+        if posting is not None:
+            return posting
+        frozen = self._frozen.get(room_id)
+        span = frozen[0].get(token) if frozen is not None else None
+        if span is not None:
+            start, end = span
+            posting = room_postings[token] = (frozen[1][start:end], frozen[2][start:end])
+        elif create:
+            posting = room_postings[token] = (array("I"), array("I"))
+        return posting
+
+    def add(self, room_id: str | None, thread_id: str | None, event_id: str | None, role: str, text: str) -> None:
+        if not (room_id and thread_id and event_id and text):
+            return
+        with self._index_lock:
+            if event_id in self.event_ids:
+                return
+            record = [room_id, thread_id, event_id, role, time.time(), text]
+            self._index(*record)
+            try:
+                os.makedirs(os.path.dirname(self._storage_path), exist_ok=True)
+                with open(self._storage_path, "ab") as f:
+                    f.write((json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8"))
+                    self._log_offset = f.tell()
+            except Exception as e:
+                self.logger.error(f"Failed to save search index entry: {e}")
+                return
+            self._unsaved += 1
+            if self._unsaved >= self.SNAPSHOT_EVERY:
+                self._save_snapshot()
+
+    def _index(self, room_id: str, thread_id: str, event_id: str, role: str, timestamp: float, text: str) -> None:
+        if event_id in self.event_ids:
+            return
+        doc_id = len(self.docs)
+        snippet = " ".join(text.split())[: self.SNIPPET_LEN]
+        self.docs.append((room_id, thread_id, event_id, role, timestamp, snippet))
+        self.event_ids.add(event_id)
+        self.room_sizes[room_id] = self.room_sizes.get(room_id, 0) + 1
+
+        tokens = tokenize(text)
+        self.doc_lengths.append(len(tokens))
+        self.total_length += len(tokens)
+        counts: Dict[str, int] = {}
+        for token in tokens:
+            counts[token] = counts.get(token, 0) + 1
+        for token, tf in counts.items():
+            posting = self._posting(room_id, token, create=True)
+            posting[0].append(doc_id)
+            posting[1].append(tf)
+
+    def search(
+        self,
+        query: str,
+        room_id: str | None = None,
+        page: int = 1,
+        page_size: int = 10,
+        alive: Callable[[str], bool] | None = None,
+    ) -> SearchResults:
+        """BM25 排序，只返回包含所有词的结果。
+
+        最短倒排表较短时对所有候选精确打分，所有词都是高频词时改用 _search_impact 提前终止。
+        """
+        terms = query_terms(query)
+        if not terms:
+            return SearchResults(0, [])
+
+        start = (max(page, 1) - 1) * page_size
+        needed = start + page_size
+        with self._index_lock:
+            if not self.docs:
+                return SearchResults(0, [])
+            total = 0
+            approximate = ranked_approximately = False
+            ranked: List[Tuple[float, float, int]] = []
+            for room in [room_id] if room_id is not None else list(self.postings):
+                found = {t: self._posting(room, t) for t in terms}
+                if any(posting is None for posting in found.values()):
+                    continue
+                # 从最短的倒排表开始
+                ordered = sorted(terms, key=lambda t: len(found[t][0]))
+                postings = [found[t] for t in ordered]
+                n_docs = self.room_sizes[room]
+                weights = [
+                    math.log(1 + (n_docs - len(ids) + 0.5) / (len(ids) + 0.5)) * (self.K1 + 1) for ids, _ in postings
+                ]
+                if len(postings[0][0]) <= self.EXACT_MAX_DF:
+                    count, hits = self._search_exact(postings, weights, needed, alive)
+                else:
+                    count, hits, estimated, cut_short = self._search_impact(
+                        room, ordered, postings, weights, needed, alive
+                    )
+                    approximate = approximate or estimated
+                    ranked_approximately = ranked_approximately or cut_short
+                total += count
+                ranked.extend(hits)
+
+            # 分数相同的按时间倒序
+            top = heapq.nlargest(needed, ranked)[start:]
+            docs = self.docs
+            hits = [SearchHit(score, *docs[doc_id]) for score, _, doc_id in top]
+        return SearchResults(total, hits, approximate, ranked_approximately)
+
+    def _bm25_params(self) -> Tuple[float, float]:
+        avg_len = self.total_length / len(self.docs) if self.docs else 1
+        return self.K1 * (1 - self.B), self.K1 * self.B / (avg_len or 1)
+
+    @staticmethod
+    def _lookup_tf(posting: Posting, doc_id: int) -> int:
+        ids = posting[0]
+        i = bisect.bisect_left(ids, doc_id)
+        return posting[1][i] if i < len(ids) and ids[i] == doc_id else 0
+
+    def _search_exact(
+        self, postings: List[Posting], weights: List[float], needed: int, alive: Callable[[str], bool] | None
+    ) -> Tuple[int, List[Tuple[float, float, int]]]:
+        base, slope = self._bm25_params()
+        lengths = self.doc_lengths
+        docs = self.docs
+        others = list(zip(postings[1:], weights[1:]))
+        count = 0
+        ranked = []
+        for doc_id, tf in zip(*postings[0]):
+            norm = base + slope * lengths[doc_id]
+            score = weights[0] * tf / (tf + norm)
+            for posting, weight in others:
+                other_tf = self._lookup_tf(posting, doc_id)
+                if not other_tf:
+                    break
+                score += weight * other_tf / (other_tf + norm)
+            else:
+                doc = docs[doc_id]
+                if alive is None or alive(doc[2]):
+                    count += 1
+                    ranked.append((score, doc[4], doc_id))
+        return count, heapq.nlargest(needed, ranked)
+
+    def _impact_order(self, room_id: str, token: str, posting: Posting) -> Tuple[int, array]:
+        """按单词贡献 tf / (tf + 长度归一化) 降序排列的下标；倒排表增长超过 1/16 后重新排序。"""
+        ids, tfs = posting
+        cached = self._impacts.get((room_id, token))
+        if cached is not None and len(ids) <= cached[0] + cached[0] // 16:
+            return cached
+        base, slope = self._bm25_params()
+        lengths = self.doc_lengths
+        impacts = [tf / (tf + base + slope * lengths[doc_id]) for doc_id, tf in zip(ids, tfs)]
+        # 贡献相同的按 doc id 降序，与结果中同分按时间倒序一致
+        order = sorted(range(len(ids) - 1, -1, -1), key=impacts.__getitem__, reverse=True)
+        cached = self._impacts[(room_id, token)] = (len(ids), array("I", order))
+        return cached
+
+    def _search_impact(
+        self,
+        room_id: str,
+        terms: List[str],
+        postings: List[Posting],
+        weights: List[float],
+        needed: int,
+        alive: Callable[[str], bool] | None,
+    ) -> Tuple[int, List[Tuple[float, float, int]], bool, bool]:
+        """阈值算法：逐层取各词影响力顺序中的下一篇文档并完整打分。
+
+        每一层各词前沿贡献之和是所有未见文档的分数上界，第 needed 名的分数不低于该上界时结果精确；
+        达到该条件即停止，此时排序精确而总数为抽样估算；已凑满 needed 条但走满 WALK_LIMIT 层
+        仍未达到时返回近似排序，由调用方标注。
+        """
+        base, slope = self._bm25_params()
+        lengths = self.doc_lengths
+        docs = self.docs
+        scored = list(zip(postings, weights))
+        lists = [(posting, weight, *self._impact_order(room_id, term, posting)) for term, posting, weight in zip(terms, postings, weights)]
+        top: List[Tuple[float, float, int]] = []
+        seen: set[int] = set()
+
+        def consider(doc_id: int) -> bool:
+            seen.add(doc_id)
+            norm = base + slope * lengths[doc_id]
+            score = 0.0
+            for posting, weight in scored:
+                tf = self._lookup_tf(posting, doc_id)
+                if not tf:
+                    return False
+                score += weight * tf / (tf + norm)
+            doc = docs[doc_id]
+            if alive is None or alive(doc[2]):
+                entry = (score, doc[4], doc_id)
+                if len(top) < needed:
+                    heapq.heappush(top, entry)
+                elif entry > top[0]:
+                    heapq.heapreplace(top, entry)
+            return True
+
+        # 排序之后新增的文档不在影响力顺序中，逐一检查
+        matched = 0
+        for posting, _, sorted_n, _ in lists:
+            for doc_id in posting[0][sorted_n:]:
+                if doc_id not in seen:
+                    matched += consider(doc_id)
+
+        depth = 0
+        exhausted = False
+        while True:
+            threshold = 0.0
+            for posting, weight, sorted_n, order in lists:
+                if depth >= sorted_n:
+                    # 某个词的文档已全部检查过，未见文档不可能包含所有词
+                    exhausted = True
+                    break
+                pos = order[depth]
+                doc_id, tf = posting[0][pos], posting[1][pos]
+                threshold += weight * tf / (tf + base + slope * lengths[doc_id])
+                if doc_id in seen:
+                    continue
+                matched += consider(doc_id)
+            if exhausted:
+                break
+            depth += 1
+            # 未见文档与第 needed 名同分时可能更新而排在前面，因此要求严格大于
+            if len(top) >= needed:
+                if top[0][0] > threshold:
+                    break
+                if depth >= self.WALK_LIMIT:
+                    return self._estimate_matches(postings), top, True, True
+
+        if exhausted:
+            return matched, top, False, False
+        return self._estimate_matches(postings), top, True, False
+
+    def _estimate_matches(self, postings: List[Posting]) -> int:
+        """在最短倒排表上等距抽样，按同时包含其他词的比例估算结果总数。
+
+        影响力靠前的文档偏短，用遍历过的文档估算会偏低，因此单独抽样。
+        """
+        ids = postings[0][0]
+        if len(postings) == 1:
+            return len(ids)
+        step = max(len(ids) // self.ESTIMATE_SAMPLES, 1)
+        sample = ids[::step]
+        hits = sum(all(self._lookup_tf(posting, doc_id) for posting in postings[1:]) for doc_id in sample)
+        return round(hits / len(sample) * len(ids))
+
+    @staticmethod
+    def format_results_markdown(query: str, results: SearchResults, page: int, page_size: int) -> str:
+        if not results.hits:
+            return f"没有找到与“{query}”相关的消息。"
+
+        pages = math.ceil(results.total / page_size)
+        total = f"约 {results.total}" if results.approximate else str(results.total)
+        lines = [f"“{query}”的搜索结果（共 {total} 条，第 {page}/{pages} 页）：\n"]
+        if results.ranked_approximately:
+            lines.insert(0, "查询过于宽泛，以下结果按近似相关度排序。")
+        for idx, hit in enumerate(results.hits, start=(page - 1) * page_size + 1):
+            role = "用户" if hit.role == "user" else "AI"
+            link = f"https://matrix.to/#/{hit.room_id}/{hit.event_id}"
+            lines.append(f"{idx}. [{role}] {hit.snippet}\nthread_id: {hit.thread_id}\n{link}\n")
+        if page < pages:
+            lines.append(f"使用 !search \"{query}\" {page + 1} 查看下一页")
+        return "\n".join(lines)
@@ -0,0 +1,192 @@
+import html as html_lib
+import json
+import re
+from typing import List, Tuple
+
+from .matrix_client import MatrixClient
+
+# (body, formatted_body)，formatted_body 为 None 时使用 body
+Segment = Tuple[str, str | None]
+
+_TAG_RE = re.compile(r"<(/?)([a-zA-Z][a-zA-Z0-9]*)\b[^>]*?(/?)>")
+_VOID_TAGS = {"br", "hr", "img", "input", "meta", "link", "wbr"}
+_BLOCK_BREAKS = re.compile(r"<br\s*/?>|</p\s*>|</div\s*>|</h[1-6]\s*>|</li\s*>|</blockquote\s*>|</pre\s*>", re.I)
+
+
+# 编辑事件中除正文外的固定部分（键名、m.relates_to 与被编辑的 event_id 等）
+_EDIT_OVERHEAD = len(
+    json.dumps(MatrixClient._edit_content("", "$" + "x" * 43), separators=(",", ":")).encode("utf-8")
+)
+# Megolm 密文的 JSON 外壳（algorithm、sender_key、session_id、device_id）、
+# 明文中的 type/room_id，以及消息头、MAC 与签名，取宽松的上界
+_MEGOLM_OVERHEAD = 512
+
+
+def _json_len(text: str, ascii_only: bool) -> int:
+    return len(json.dumps(text, ensure_ascii=ascii_only).encode("utf-8")) - 2
+
+
+def _size(segment: Segment, encrypted: bool = False) -> int:
+    """以该段作为编辑事件（MatrixClient._edit_content）发送时的内容大小。
+
+    编辑事件在 m.new_content 与外层回退中各带一份 body 和 formatted_body，
+    formatted_body 缺省时用 body 填充。加密房间中 nio 以 ASCII 转义的 JSON 加密，
+    非 ASCII 字符变为 \\uXXXX，密文再经 base64 增大三分之一。
+    """
+    body, formatted = segment
+    size = _EDIT_OVERHEAD + 2 * _json_len(body, encrypted) + 2 * _json_len(formatted if formatted else body, encrypted)
+    if encrypted:
+        size = size * 4 // 3 + _MEGOLM_OVERHEAD
+    return size
+
+
+def html_to_text(fragment: str) -> str:
+    text = _BLOCK_BREAKS.sub(lambda m: "\n" if m.group(0).lower().startswith("<br") else "\n\n", fragment)
+    text = re.sub(r"<[^>]+>", "", text)
+    text = html_lib.unescape(text)
+    return re.sub(r"\n{3,}", "\n\n", text).strip("\n")
+
+
+def _split_html_blocks(fragment: str) -> List[str]:
+    """在顶层块元素结束处（或顶层 <br> 之后）切分 HTML，保证每块的标签完整闭合。"""
+    blocks: List[str] = []
+    depth = 0
+    start = 0
+    for match in _TAG_RE.finditer(fragment):
+        closing, tag, self_closing = match.group(1), match.group(2).lower(), match.group(3)
+        if tag in _VOID_TAGS or self_closing:
+            if tag == "br" and depth == 0:
+                blocks.append(fragment[start:match.end()])
+                start = match.end()
+            continue
+        if closing:
+            depth = max(depth - 1, 0)
+            if depth == 0:
+                blocks.append(fragment[start:match.end()])
+                start = match.end()
+        else:
+            depth += 1
+    if start < len(fragment):
+        blocks.append(fragment[start:])
+    return [b for b in blocks if b.strip()]
+
+
+def _hard_cut(text: str, max_bytes: int, encrypted: bool) -> List[str]:
+    """没有任何分隔符（如长段中文）时，二分查找每段能容纳的最多字符数后硬切。"""
+    pieces: List[str] = []
+    while text:
+        lo, hi = 1, len(text)
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            if _size((text[:mid], None), encrypted) <= max_bytes:
+                lo = mid
+            else:
+                hi = mid - 1
+        pieces.append(text[:lo])
+        text = text[lo:]
+    return pieces
+
+
+def _split_text(text: str, max_bytes: int, encrypted: bool = False) -> List[str]:
+    """按段落、行、空白的优先级切分纯文本，最后才按字符硬切。"""
+    if _size((text, None), encrypted) <= max_bytes:
+        return [text]
+    for sep in ("\n\n", "\n", " "):
+        parts = text.split(sep)
+        if len(parts) > 1:
+            break
+    else:
+        return _hard_cut(text, max_bytes, encrypted)
+
+    pieces: List[str] = []
+    current = ""
+    for part in parts:
+        candidate = f"{current}{sep}{part}" if current else part
+        if _size((candidate, None), encrypted) <= max_bytes:
+            current = candidate
+            continue
+        if current:
+            pieces.append(current)
+        if _size((part, None), encrypted) > max_bytes:
+            pieces.extend(_split_text(part, max_bytes, encrypted))
+            current = ""
+        else:
+            current = part
+    if current:
+        pieces.append(current)
+    return pieces
+
+
+def split_reply(text: str, html: str | None, max_bytes: int, encrypted: bool = False) -> List[Segment]:
+    """把过长的回复切分为多段，每段作为编辑事件发送时的大小不超过 max_bytes。
+
+    有 HTML 时按顶层块切分并从 HTML 还原每段的纯文本；单个块仍然过大时退化为纯文本切分。
+    前面的段只在其内容变化时才会变化，因此继续追加文本时已冻结的段保持不变。
+    """
+    if _size((text, html), encrypted) <= max_bytes:
+        return [(text, html)]
+    if not html:
+        return [(piece, None) for piece in _split_text(text, max_bytes, encrypted)]
+
+    segments: List[Segment] = []
+    current = ""
+    for block in _split_html_blocks(html):
+        candidate = current + block
+        if _size((html_to_text(candidate), candidate), encrypted) <= max_bytes:
+            current = candidate
+            continue
+        if current:
+            segments.append((html_to_text(current), current))
+        if _size((html_to_text(block), block), encrypted) > max_bytes:
+            segments.extend((piece, None) for piece in _split_text(html_to_text(block), max_bytes, encrypted))
+            current = ""
+        else:
+            current = block
+    if current:
+        segments.append((html_to_text(current), current))
+    return segments
+
+
+class SegmentedReply:
+    """把一条回复映射为同一线程中的多个 Matrix 事件。
+
+    每次更新只编辑内容发生变化的段，新增的段作为新事件发送，
+    因此无论回复多长，单次编辑的负载都不超过一个段的大小。
+    """
+
+    def __init__(
+        self,
+        matrix_client: MatrixClient,
+        room_id: str | None,
+        thread_id: str | None,
+        max_bytes: int,
+        placeholder_event_id: str | None = None,
+        encrypted: bool = False,
+    ):
+        self.matrix_client = matrix_client
+        self.room_id = room_id
+        self.thread_id = thread_id
+        self.max_bytes = max_bytes
+        self.encrypted = encrypted
+        self.event_ids: List[str] = [placeholder_event_id] if placeholder_event_id else []
+        self.sent: List[Segment | None] = [None] * len(self.event_ids)
+
+    async def update(self, text: str, html: str | None = None) -> List[str]:
+        segments = split_reply(text, html, self.max_bytes, self.encrypted)
+        for i, segment in enumerate(segments):
+            body, formatted = segment
+            if i < len(self.event_ids):
+                if self.sent[i] == segment:
+                    continue
+                await self.matrix_client.edit_text(body, self.room_id, self.event_ids[i], html=formatted)
+                self.sent[i] = segment
+            else:
+                event_id = await self.matrix_client.send_text(body, self.room_id, self.thread_id, html=formatted)
+                self.event_ids.append(event_id)
+                self.sent.append(segment)
+
+        # 回复变短时删除多余的段
+        while len(self.event_ids) > max(len(segments), 1):
+            await self.matrix_client.delete_text(self.room_id, self.event_ids.pop())
+            self.sent.pop()
+        return self.event_ids
@@ -1,36 +1,68 @@
 import asyncio
-import json
 import logging
 from typing import Dict, Any
 
 import websockets
 from websockets.asyncio.server import ServerConnection
+from websockets.extensions.permessage_deflate import ServerPerMessageDeflateFactory
 
 from .matrix_client import MatrixClient
 from .event_tracker import EventTracker
+from .backfill import BackfillSession
+from .segmenter import SegmentedReply
+from .search_index import SearchIndex
+from .traffic_recorder import TrafficRecorder, ST_IN, ST_OUT
+from . import ws_codec
 from utils.singleton import SingletonMixin
 
 
 class SillyTavernServer(SingletonMixin):
-    def __init__(self, matrix_client: MatrixClient, event_tracker: EventTracker, cfg, logger: logging.Logger):
+    def __init__(
+        self,
+        matrix_client: MatrixClient,
+        event_tracker: EventTracker,
+        cfg,
+        logger: logging.Logger,
+        search_index: SearchIndex | None = None,
+        traffic_recorder: TrafficRecorder | None = None,
+    ):
         super().__init__(cfg, logger)
         self.server = None
         self.wss_port = cfg.wss_port
         self.matrix_client = matrix_client
         self.event_tracker = event_tracker
+        self.search_index = search_index
+        self.traffic_recorder = traffic_recorder
         self.room_id: str | None = None
         # SillyTavern 当前会话所在的 Matrix 线程根 event_id
         self.thread_id: str | None = None
         self.ongoing_streams: Dict[str, Dict[str, Any]] = {}
+        # 正在进行的聊天记录回填：{chat_id: BackfillSession}
+        self.backfills: Dict[str, BackfillSession] = {}
+        # 握手协商的特性，每次新连接时重置
+        self.features: set[str] = set()
 
     async def start(self):
         self.logger.info(f"Starting WebSocket server on port {self.wss_port}")
-        async with websockets.serve(self.handle_connection, "0.0.0.0", self.wss_port):
+        async with websockets.serve(self.handle_connection, "0.0.0.0", self.wss_port, **self._compression_options()):
             await asyncio.Future()
 
+    def _compression_options(self) -> Dict[str, Any]:
+        if self.cfg.wss_deflate_level <= 0:
+            return {"compression": None}
+        # 默认值（级别 6、窗口 12、memLevel 5）与 websockets 自带的设置相同，这里只是让级别与窗口可配置
+        window_bits = self.cfg.wss_deflate_window_bits
+        factory = ServerPerMessageDeflateFactory(
+            server_max_window_bits=window_bits,
+            client_max_window_bits=window_bits,
+            compress_settings={"level": self.cfg.wss_deflate_level, "memLevel": 5},
+        )
+        return {"compression": None, "extensions": [factory]}
+
     async def handle_connection(self, ws: ServerConnection):
         self.logger.info("SillyTavern extension connected!")
         self.server = ws
+        self.features = set()
         try:
             async for message in ws:
                 await self.handle_message(message)
@@ -43,19 +75,33 @@ class SillyTavernServer(SingletonMixin):
             self.server = None
             self.ongoing_streams.clear()
 
-    async def handle_message(self, message: str):
-        if not self.room_id:
-            return
+    async def handle_message(self, message: str | bytes):
         try:
-            data = json.loads(message)
+            data = ws_codec.decode(message)
+            if self.traffic_recorder is not None:
+                self.traffic_recorder.record(ST_IN, message, self.room_id)
+            if data.get("type") == "hello":
+                await self.handle_hello(data)
+                return
+            if not self.room_id:
+                return
             text = data.get("text", "").rstrip("\n")
             msg_type = data.get("type")
             chat_id = data.get("chatId")
 
             try:
+                backfill = self.backfills.get(chat_id) if chat_id else None
+                if backfill is not None and msg_type in ["backfill_page", "error_message"]:
+                    if msg_type == "backfill_page":
+                        await backfill.feed(data)
+                    else:
+                        await backfill.abort(text)
                 # 处理最终渲染后的消息更新
-                if msg_type in ["final_message_update", "ai_reply"] and chat_id:
+                elif msg_type in ["final_message_update", "ai_reply"] and chat_id:
                     html = data.get("html")
+                    # 协商了 html_auto 时，扩展省略的 html 由桥接程序从文本渲染
+                    if html is None and ws_codec.FEATURE_HTML_AUTO in self.features:
+                        html = ws_codec.render_text_html(text)
                     await self.handle_final_message_update(msg_type, text, chat_id, html)
                 else:
                     await self.handle_other_message_type(msg_type, text, chat_id)
@@ -67,30 +113,67 @@ class SillyTavernServer(SingletonMixin):
                     self.thread_id,
                 )
 
-        except json.JSONDecodeError as e:
+        except ValueError as e:
             self.logger.error(f"Failed to parse message: {e}")
 
+    async def handle_hello(self, data: Dict[str, Any]) -> None:
+        """扩展连接后的能力握手：选择双方都支持的编码与特性。"""
+        codec = ws_codec.negotiate(data.get("codecs", []))
+        features = set(data.get("features", [])) & set(ws_codec.SUPPORTED_FEATURES)
+        await self.send({"type": "hello_ack", "codec": codec, "features": sorted(features)})
+        self.features = features
+        self.logger.info(f"Negotiated codec {codec} with features {sorted(features)}")
+
+    async def send(self, payload: Dict[str, Any]) -> None:
+        """向扩展发送一帧；调用方需先确认连接可用。"""
+        frame = ws_codec.encode(payload)
+        if self.traffic_recorder is not None:
+            self.traffic_recorder.record(ST_OUT, frame, self.room_id)
+        await self.server.send(frame)
+
+    async def start_backfill(self, room_id: str, chat_id: str, chat_name: str = "") -> None:
+        """在后台回填聊天记录，不阻塞 WebSocket 消息处理。"""
+        self.room_id = room_id
+        session = BackfillSession(self, room_id, chat_id, chat_name)
+        self.backfills[chat_id] = session
+
+        async def run():
+            try:
+                await session.run()
+            finally:
+                self.backfills.pop(chat_id, None)
+
+        # 保存任务引用，避免被垃圾回收
+        session.task = asyncio.create_task(run())
+
     async def handle_final_message_update(self, msg_type: str, text: str, chat_id: str, html: str | None = None):
-        event_id = None
         session = self.ongoing_streams.get(chat_id, {})
-
-        if session:
-            event_id = session["event_id"]
-            await self.matrix_client.edit_text(text, self.room_id, event_id, html=html)
-        else:
-            event_id = await self.matrix_client.send_text(
-                text,
+        reply = session.get("reply")
+        if reply is None:
+            # 过长的回复会被切分为同一线程中的多条消息，首段复用“思考中...”占位消息
+            reply = SegmentedReply(
+                self.matrix_client,
                 self.room_id,
                 self.thread_id,
-                html=html,
+                self.cfg.mx_segment_max_bytes,
+                placeholder_event_id=session.get("event_id"),
+                encrypted=self.matrix_client.is_encrypted(self.room_id),
             )
+            if session:
+                session["reply"] = reply
+        event_ids = await reply.update(text, html)
 
         if msg_type == "final_message_update":
-            self.event_tracker.track_event_id(self.thread_id, event_id)
+            head_event_id = event_ids[0] if event_ids else None
+            self.event_tracker.track_event_id(self.thread_id, head_event_id)
+            self.event_tracker.track_segment_event_ids(head_event_id, event_ids[1:])
+            if self.search_index is not None:
+                self.search_index.add(self.room_id, self.thread_id, head_event_id, "ai", text)
             if session:
                 del self.ongoing_streams[chat_id]
         else:
-            self.event_tracker.track_trash_event_id(event_id)
+            for event_id in event_ids:
+                self.event_tracker.track_trash_event_id(event_id)
 
         self.logger.info(f"Sent message {text}")
 
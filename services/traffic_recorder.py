@@ -0,0 +1,59 @@
+import json
+import threading
+import time
+from typing import Any, Iterator, List
+
+from utils import SingletonMixin
+
+# 记录类型：Matrix 入站事件、扩展发来的帧、发往扩展的帧
+MATRIX_IN = "mx"
+ST_IN = "st_in"
+ST_OUT = "st_out"
+
+
+class TrafficRecorder(SingletonMixin):
+    """可选的流量录制器，把带时间戳的 Matrix 事件与 WebSocket 帧追加写入日志。
+
+    每行是一个紧凑的 JSON 数组：[timestamp, kind, room_id, payload]。
+    未配置 TRAFFIC_RECORD_PATH 时所有调用都是空操作。
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.path = self.cfg.traffic_record_path
+        self._file = None
+        # Matrix 事件在 bot 线程中录制，WebSocket 帧在主线程中录制
+        self._write_lock = threading.Lock()
+        if self.path:
+            self._file = open(self.path, "a", encoding="utf-8", buffering=1)
+            self.logger.info(f"Recording bridge traffic to {self.path}")
+
+    @property
+    def enabled(self) -> bool:
+        return self._file is not None
+
+    def record(self, kind: str, payload: Any, room_id: str | None = None) -> None:
+        if self._file is None:
+            return
+        line = json.dumps([time.time(), kind, room_id, payload], ensure_ascii=False, separators=(",", ":"))
+        try:
+            with self._write_lock:
+                self._file.write(line + "\n")
+        except Exception as e:
+            self.logger.error(f"Failed to record traffic: {e}")
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    @staticmethod
+    def load(path: str) -> List[list]:
+        return list(TrafficRecorder.iter_records(path))
+
+    @staticmethod
+    def iter_records(path: str) -> Iterator[list]:
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
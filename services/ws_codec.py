@@ -0,0 +1,37 @@
+import html as html_lib
+import json
+import re
+from typing import Any, Dict, List
+
+# 回复以中文为主，MessagePack 帧并不比 JSON 小，解析反而更慢，因此只支持 JSON；
+# 握手仍协商编码，以便日后增加其他编码时保持兼容
+JSON = "json"
+SUPPORTED_CODECS = [JSON]
+# 扩展只在 HTML 与桥接程序自行渲染的结果有实质差异时才发送 html 字段
+FEATURE_HTML_AUTO = "html_auto"
+
+SUPPORTED_FEATURES = [FEATURE_HTML_AUTO]
+
+
+def negotiate(offered: List[str]) -> str:
+    for codec in SUPPORTED_CODECS:
+        if codec in offered:
+            return codec
+    return JSON
+
+
+def encode(data: Dict[str, Any]) -> str:
+    return json.dumps(data, ensure_ascii=False)
+
+
+def decode(message: str | bytes) -> Dict[str, Any]:
+    """文本帧按 JSON 解码；不支持二进制帧。"""
+    if isinstance(message, (bytes, bytearray)):
+        raise ValueError("Binary frames are not supported")
+    return json.loads(message)
+
+
+def render_text_html(text: str) -> str:
+    """桥接程序从纯文本渲染的 HTML，与 index.js 中 isTrivialHtml 的判断保持一致。"""
+    paragraphs = re.split(r"\n{2,}", html_lib.escape(text))
+    return "".join(f"<p>{p.replace(chr(10), '<br>')}</p>" for p in paragraphs if p)
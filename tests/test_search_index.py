@@ -0,0 +1,107 @@
+import logging
+import random
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+from services.search_index import SearchIndex
+from utils import SingletonMixin
+
+VOCAB = ["我们", "他们", "知道", "现在", "dragon", "river", "sword", "猫咪"]
+QUERIES = ["我们", "我们 他们", "dragon 知道", "我们 他们 知道 现在", "猫", "river 的"]
+
+
+def make_index(path) -> SearchIndex:
+    SingletonMixin._instances.pop(SearchIndex, None)
+    return SearchIndex(SimpleNamespace(mx_store_path=str(path)), logging.getLogger("test"))
+
+
+def fill(index: SearchIndex, count: int, seed: int = 0, start: int = 0) -> None:
+    rng = random.Random(seed)
+    for i in range(start, start + count):
+        words = [rng.choice(VOCAB) for _ in range(rng.randint(1, 12))]
+        if rng.random() < 0.3:
+            words.append("的")
+        index.add(rng.choice(["!a", "!b"]), "$thread", f"$e{i}", "user", "，".join(words))
+
+
+def ranking(index: SearchIndex, query: str, page: int = 1, room_id: str | None = "!a"):
+    results = index.search(query, room_id, page=page)
+    return [(round(hit.score, 9), hit.event_id) for hit in results.hits], results
+
+
+@pytest.fixture
+def index(tmp_path):
+    index = make_index(tmp_path)
+    yield index
+    SingletonMixin._instances.pop(SearchIndex, None)
+
+
+def test_single_cjk_character(index):
+    index.add("!a", "$thread", "$1", "user", "我的猫很可爱")
+    index.add("!a", "$thread", "$2", "assistant", "hello 的确如此")
+    assert [hit.event_id for hit in index.search("猫", "!a").hits] == ["$1"]
+    assert [hit.event_id for hit in index.search("hello 的", "!a").hits] == ["$2"]
+    assert index.search("可爱", "!a").total == 1
+    assert index.search("狗", "!a").total == 0
+
+
+def test_impact_matches_exact(index, monkeypatch):
+    fill(index, 3000)
+    monkeypatch.setattr(SearchIndex, "EXACT_MAX_DF", 10**9)
+    exact = {(q, page): ranking(index, q, page) for q in QUERIES for page in (1, 3)}
+
+    monkeypatch.setattr(SearchIndex, "EXACT_MAX_DF", 0)
+    for (query, page), (expected, exact_results) in exact.items():
+        hits, results = ranking(index, query, page)
+        assert hits == expected, (query, page)
+        assert not results.ranked_approximately
+        if not results.approximate:
+            assert results.total == exact_results.total
+
+
+def test_walk_limit_marks_ranking_approximate(index, monkeypatch):
+    fill(index, 3000)
+    monkeypatch.setattr(SearchIndex, "EXACT_MAX_DF", 0)
+    monkeypatch.setattr(SearchIndex, "WALK_LIMIT", 1)
+    results = index.search("我们 他们", "!a", page=3)
+    assert results.ranked_approximately
+    assert "近似相关度" in SearchIndex.format_results_markdown("我们 他们", results, 3, 10)
+
+
+def test_snapshot_round_trip(tmp_path, index):
+    fill(index, 1500)
+    with index._index_lock:
+        index._save_snapshot()
+    # 等待后台线程写完快照
+    with index._snapshot_lock:
+        pass
+    assert (tmp_path / "search_index.snapshot").exists()
+    # 快照之后追加的发言在下次启动时从日志重放
+    fill(index, 200, seed=1, start=1500)
+    expected = {q: ranking(index, q, room_id=None)[0] for q in QUERIES}
+
+    reloaded = make_index(tmp_path)
+    assert reloaded is not index
+    assert len(reloaded.docs) == 1700
+    for query in QUERIES:
+        assert ranking(reloaded, query, room_id=None)[0] == expected[query], query
+
+
+def test_concurrent_adds(tmp_path, index):
+    def worker(n: int) -> None:
+        for i in range(300):
+            index.add("!a", "$thread", f"$w{n}-{i}", "user", f"我们 dragon {n}")
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert len(index.docs) == len(index.event_ids) == 1200
+    assert index.search("dragon", "!a").total == 1200
+    with open(tmp_path / "search_index.jsonl", encoding="utf-8") as f:
+        assert sum(1 for _ in f) == 1200
+    assert len(make_index(tmp_path).docs) == 1200
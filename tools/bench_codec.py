@@ -0,0 +1,86 @@
+"""比较扩展 WebSocket 帧的线上字节数与每帧解析耗时。
+
+对每种回复分别测量是否省略可由文本渲染的 html，
+以及是否经过 permessage-deflate（按单帧、无上下文复用的 raw deflate 近似）。
+
+用法：
+    python -m tools.bench_codec --level 6 --window-bits 12
+"""
+import argparse
+import json
+import random
+import timeit
+import zlib
+
+from services import ws_codec
+
+# 常用汉字与英文单词，随机组句，避免重复文本让压缩率失真
+HANZI = "的一是在不了有和人这中大为上个国我以要他时来用们生到作地于出就分对成会可主发年动同工也能下过子说产种面而方后多定行学法所民得经十三之进着等部度家电力里如水化高自二理起小物现实加量都两体制机当使点从业本去把性好应开它合还因由其些然前外天政四日那社义事平形相全表间样与关各重新线内数正心反你明看原又么利比或但质气第向道命此变条只没结解问意建月公无系军很情者最立代想已通并提直题党程展五果料象员革位入常文总次品式活设及管特件长求老头基资边流路级少图山统接知较将组见计别她手角期根论运农指几九区强放决西被干做必战先回则任取据处理府研质"
+WORDS = ["the", "river", "lantern", "quietly", "she", "said", "door", "rain", "map", "old", "smiled", "whisper"]
+
+
+def make_sentence(rng: random.Random) -> str:
+    if rng.random() < 0.2:
+        return " ".join(rng.choice(WORDS) for _ in range(rng.randint(6, 14))).capitalize() + ". "
+    body = "".join(rng.choice(HANZI) for _ in range(rng.randint(10, 30)))
+    return f"“{body}”" if rng.random() < 0.3 else body + "。"
+
+
+def make_reply(paragraphs: int, formatted: bool, seed: int = 0) -> dict:
+    rng = random.Random(seed)
+    paras = ["".join(make_sentence(rng) for _ in range(4)) for _ in range(paragraphs)]
+    text = "\n\n".join(paras)
+    if formatted:
+        # SillyTavern 渲染后的典型 HTML：带斜体动作描写
+        html = "".join(f"<p><em>{p[:20]}</em>{p[20:]}</p>" for p in paras)
+    else:
+        html = ws_codec.render_text_html(text)
+    return {"type": "final_message_update", "chatId": "$" + "x" * 43, "text": text, "html": html}
+
+
+def variants(frame: dict):
+    trimmed = dict(frame)
+    # html_auto：扩展只在 HTML 有实质格式时才发送
+    if frame["html"] == ws_codec.render_text_html(frame["text"]):
+        del trimmed["html"]
+    yield "json", json.dumps(frame, ensure_ascii=False).encode("utf-8"), json.loads
+    yield "json+html_auto", json.dumps(trimmed, ensure_ascii=False).encode("utf-8"), json.loads
+
+
+def deflate(data: bytes, level: int, window_bits: int) -> bytes:
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -window_bits, 5)
+    return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--level", type=int, default=6, help="deflate 压缩级别")
+    parser.add_argument("--window-bits", type=int, default=12, help="deflate 窗口大小")
+    parser.add_argument("--number", type=int, default=500, help="每项解析计时的重复次数")
+    args = parser.parse_args()
+
+    replies = {
+        "typical plain": make_reply(4, formatted=False),
+        "typical formatted": make_reply(4, formatted=True),
+        "long plain": make_reply(200, formatted=False),
+        "long formatted": make_reply(200, formatted=True),
+    }
+    print(f"{'reply':<18}{'codec':<19}{'bytes':>9}{'deflated':>10}{'parse us':>10}{'inflate+parse us':>18}")
+    for name, frame in replies.items():
+        for codec, payload, parse in variants(frame):
+            compressed = deflate(payload, args.level, args.window_bits)
+            # JSON 帧在 WebSocket 上是文本帧，websockets 收到后已解码为 str
+            raw = payload.decode("utf-8")
+
+            def inflate_and_parse():
+                inflater = zlib.decompressobj(-args.window_bits)
+                parse(inflater.decompress(compressed).decode("utf-8"))
+
+            parse_us = timeit.timeit(lambda: parse(raw), number=args.number) / args.number * 1e6
+            inflate_us = timeit.timeit(inflate_and_parse, number=args.number) / args.number * 1e6
+            print(f"{name:<18}{codec:<19}{len(payload):>9}{len(compressed):>10}{parse_us:>10.1f}{inflate_us:>18.1f}")
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+"""对比新设备加入加密房间后，首条回复在开启/关闭会话预热时的发送延迟。
+
+需要真实的 homeserver。机器人账号读取 .env 中的配置，但以单独的临时设备登录，
+并像桥接程序一样在后台运行 nio 的同步循环；预热直接调用 MatrixClient._prewarm_room。
+对端账号每轮以一个新设备登录，模拟"房间内有新设备加入"。
+
+用法：
+    BENCH_ROOM_ID=... BENCH_PEER_USER_ID=... BENCH_PEER_PASSWORD=... python -m tools.bench_e2ee --rounds 5
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+
+from nio import AsyncClient, AsyncClientConfig
+
+from configs import EnvConfig
+from services.matrix_client import MatrixClient
+
+
+async def login(homeserver: str, user_id: str, password: str, device_name: str, store_path: str) -> AsyncClient:
+    client = AsyncClient(
+        homeserver,
+        user_id,
+        store_path=store_path,
+        config=AsyncClientConfig(encryption_enabled=True, store_sync_tokens=True),
+    )
+    await client.login(password, device_name=device_name)
+    await client.sync(timeout=3000, full_state=True)
+    if client.should_upload_keys:
+        await client.keys_upload()
+    return client
+
+
+async def wait_for_device(bot: AsyncClient, user_id: str, device_id: str, timeout: float = 30.0) -> None:
+    """等待同步循环查询到新设备；此时 nio 已作废房间的出站会话，下一次发送需要重新分享。"""
+    deadline = time.monotonic() + timeout
+    while device_id not in bot.device_store[user_id] or bot.should_query_keys:
+        if time.monotonic() >= deadline:
+            raise TimeoutError(f"Device {device_id} did not show up within {timeout}s")
+        await asyncio.sleep(0.05)
+
+
+async def measure_round(
+    bot: AsyncClient, matrix_client: MatrixClient, cfg: EnvConfig, args, warm: bool
+) -> tuple[float, float | None]:
+    with tempfile.TemporaryDirectory() as peer_store:
+        peer = await login(cfg.mx_homeserver, args.peer_user_id, args.peer_password, "bench-peer", peer_store)
+        try:
+            await wait_for_device(bot, args.peer_user_id, peer.device_id)
+            prewarm_ms = None
+            if warm:
+                # 桥接程序在派发 user_message 后调用同一方法，与 LLM 生成并行，这部分耗时不计入回复延迟
+                started = time.perf_counter()
+                await matrix_client._prewarm_room(args.room_id)
+                prewarm_ms = (time.perf_counter() - started) * 1000
+            started = time.perf_counter()
+            await bot.room_send(
+                args.room_id,
+                "m.room.message",
+                {"msgtype": "m.notice", "body": "e2ee latency benchmark"},
+                ignore_unverified_devices=True,
+            )
+            return (time.perf_counter() - started) * 1000, prewarm_ms
+        finally:
+            await peer.logout()
+            await peer.close()
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--room-id", default=os.getenv("BENCH_ROOM_ID"))
+    parser.add_argument("--peer-user-id", default=os.getenv("BENCH_PEER_USER_ID"))
+    parser.add_argument("--peer-password", default=os.getenv("BENCH_PEER_PASSWORD"))
+    args = parser.parse_args()
+    if not (args.room_id and args.peer_user_id and args.peer_password):
+        parser.error("room id, peer user id and peer password are required")
+
+    cfg = EnvConfig.load_config()
+    logger = EnvConfig.load_logger()
+    with tempfile.TemporaryDirectory() as bot_store:
+        bot = await login(cfg.mx_homeserver, cfg.mx_user_id, cfg.mx_password, "bench-bot", bot_store)
+        matrix_client = MatrixClient(bot, cfg, logger)
+        sync_task = asyncio.create_task(bot.sync_forever(timeout=3000))
+        try:
+            # 先发送一条消息，排除临时设备自身首次建立会话的开销
+            await bot.room_send(
+                args.room_id, "m.room.message", {"msgtype": "m.notice", "body": "warmup"}, ignore_unverified_devices=True
+            )
+
+            results: dict[str, list[float]] = {"cold": [], "warm": []}
+            prewarm_costs: list[float] = []
+            for i in range(args.rounds):
+                for mode in ("cold", "warm"):
+                    send_ms, prewarm_ms = await measure_round(bot, matrix_client, cfg, args, warm=mode == "warm")
+                    results[mode].append(send_ms)
+                    if prewarm_ms is not None:
+                        prewarm_costs.append(prewarm_ms)
+                    print(f"round {i + 1} {mode:>4}: first reply {send_ms:8.1f} ms")
+
+            print()
+            print(f"{'mode':<6}{'median ms':>12}{'max ms':>12}")
+            for mode, values in results.items():
+                print(f"{mode:<6}{statistics.median(values):>12.1f}{max(values):>12.1f}")
+            if prewarm_costs:
+                print(f"background prewarm median: {statistics.median(prewarm_costs):.1f} ms (overlaps with generation)")
+        finally:
+            sync_task.cancel()
+            await bot.logout()
+            await bot.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,189 @@
+"""把 TRAFFIC_RECORD_PATH 录制的流量按原速或加速回放进桥接程序，并报告延迟与吞吐。
+
+Matrix 与 SillyTavern 都替换为本地假实现：录制的 Matrix 事件交给 app.on_message，
+扩展发来的帧交给 SillyTavernServer.handle_message，Matrix 的发送/编辑/删除
+只按 --matrix-latency 模拟耗时。以 "!" 开头的命令由 niobot 分发，不在回放范围内。
+
+用法：
+    python -m tools.replay recording.jsonl --speed 10
+"""
+import argparse
+import asyncio
+import importlib
+import os
+import statistics
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+from typing import Dict, List
+
+from services import ws_codec
+from services.traffic_recorder import TrafficRecorder, MATRIX_IN, ST_IN
+
+
+class FakeMatrixClient:
+    """模拟 MatrixClient 的接口，每次调用按固定延迟返回一个新的 event_id。"""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.calls: Dict[str, int] = {}
+        self._next_id = 0
+
+    async def _op(self, name: str) -> str:
+        self.calls[name] = self.calls.get(name, 0) + 1
+        await asyncio.sleep(self.latency)
+        self._next_id += 1
+        return f"$replay{self._next_id}"
+
+    async def send_text(self, text, room_id, thread_id=None, html=None):
+        return await self._op("send")
+
+    async def edit_text(self, text, room_id, event_id, html=None):
+        return await self._op("edit")
+
+    async def delete_text(self, room_id, event_id):
+        return await self._op("delete")
+
+    async def send_texts(self, room_id, thread_id, messages, max_retries=5):
+        return [await self._op("send") for _ in messages]
+
+    async def send_in_loop(self, room_id, payload):
+        return await self._op("upload")
+
+    def schedule_prewarm(self, room_id):
+        pass
+
+    def is_encrypted(self, room_id):
+        return False
+
+
+class FakeConnection:
+    """代替扩展的 WebSocket 连接，记录每条用户消息被派发给扩展的时间。"""
+
+    state = 1
+
+    def __init__(self, sent_at: Dict[str, float]):
+        self.sent_at = sent_at
+
+    async def send(self, frame: str | bytes) -> None:
+        try:
+            data = ws_codec.decode(frame)
+        except ValueError:
+            return
+        chat_id = data.get("chatId")
+        if data.get("type") == "user_message" and chat_id and chat_id not in self.sent_at:
+            self.sent_at[chat_id] = time.perf_counter()
+
+    async def close(self) -> None:
+        pass
+
+
+def load_app(store_path: str):
+    """以回放配置导入 app：状态写入临时目录，不录制流量，也不会连接 homeserver。"""
+    os.environ.setdefault("MATRIX_HOMESERVER", "https://replay.invalid")
+    for name in ("MATRIX_USER_ID", "MATRIX_DEVICE_ID", "MATRIX_PASSWORD", "MATRIX_OWNER_ID"):
+        os.environ.setdefault(name, "replay")
+    os.environ["MATRIX_STORE_PATH"] = store_path
+    os.environ["MATRIX_ENCRYPTION_ENABLED"] = "false"
+    os.environ["TRAFFIC_RECORD_PATH"] = ""
+    return importlib.import_module("app")
+
+
+async def replay(records: List[list], speed: float, matrix_latency: float, store_path: str) -> None:
+    app = load_app(store_path)
+    # on_message 派发前的固定等待也按倍速缩短，否则加速回放时扩展的回复帧会先于对应的用户消息到达
+    app.DISPATCH_DELAY /= speed
+    fake_matrix = FakeMatrixClient(matrix_latency)
+    dispatched_at: Dict[str, float] = {}
+    app.matrix_client = fake_matrix
+    app.event_tracker.matrix_client = fake_matrix
+    app.silly_tavern_server.matrix_client = fake_matrix
+    app.silly_tavern_server.server = FakeConnection(dispatched_at)
+
+    records = [r for r in records if r[1] in (MATRIX_IN, ST_IN)]
+    if not records:
+        print("Recording contains no replayable traffic.")
+        return
+
+    start_ts = records[0][0]
+    started = time.perf_counter()
+    received_at: Dict[str, float] = {}
+    frame_latencies: List[float] = []
+    matrix_tasks: List[asyncio.Task] = []
+    # 扩展发来的帧在真实连接中按顺序处理
+    frame_queue: asyncio.Queue = asyncio.Queue()
+
+    async def consume_frames() -> None:
+        while True:
+            message = await frame_queue.get()
+            t = time.perf_counter()
+            await app.silly_tavern_server.handle_message(message)
+            frame_latencies.append(time.perf_counter() - t)
+            frame_queue.task_done()
+
+    consumer = asyncio.create_task(consume_frames())
+
+    for ts, kind, room_id, payload in records:
+        delay = (ts - start_ts) / speed - (time.perf_counter() - started)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        if kind == MATRIX_IN:
+            event_id = payload.get("event_id", "")
+            event = SimpleNamespace(
+                event_id=event_id,
+                sender=payload.get("sender", ""),
+                source=payload,
+                # 以回放时刻为准，否则会被当作过期消息忽略
+                server_timestamp=int(time.time() * 1000),
+            )
+            received_at[event_id] = time.perf_counter()
+            matrix_tasks.append(asyncio.create_task(app.on_message(SimpleNamespace(room_id=room_id), event)))
+        else:
+            await frame_queue.put(payload)
+
+    await asyncio.gather(*matrix_tasks, return_exceptions=True)
+    await frame_queue.join()
+    consumer.cancel()
+    elapsed = time.perf_counter() - started
+
+    dispatch = [dispatched_at[e] - t for e, t in received_at.items() if e in dispatched_at]
+    recorded_span = records[-1][0] - start_ts
+    n_matrix = sum(1 for r in records if r[1] == MATRIX_IN)
+    n_frames = len(records) - n_matrix
+
+    print(f"records:                {len(records)} ({n_matrix} matrix events, {n_frames} extension frames)")
+    print(f"recorded span:          {recorded_span:.2f}s, replayed in {elapsed:.2f}s at {speed:g}x")
+    print(f"throughput:             {len(records) / elapsed:.1f} records/s")
+    for name, values in (("matrix -> dispatch", dispatch), ("frame handling", frame_latencies)):
+        if values:
+            values = sorted(v * 1000 for v in values)
+            p95 = values[min(len(values) - 1, int(len(values) * 0.95))]
+            print(
+                f"{name + ' ms:':<24}p50 {statistics.median(values):.1f}  p95 {p95:.1f}  max {values[-1]:.1f}"
+                f"  (n={len(values)})"
+            )
+    print(f"matrix calls:           {fake_matrix.calls}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("recording", help="TRAFFIC_RECORD_PATH 录制的文件")
+    parser.add_argument("--speed", type=float, default=1.0, help="回放倍速，例如 10 表示 10 倍速")
+    parser.add_argument("--matrix-latency", type=float, default=0.05, help="模拟每次 Matrix 请求的耗时（秒）")
+    args = parser.parse_args()
+    if args.speed <= 0:
+        parser.error("--speed must be positive")
+
+    records = TrafficRecorder.load(args.recording)
+    # 后台快照线程可能仍在写入，清理失败时忽略
+    with tempfile.TemporaryDirectory(prefix="replay_store_", ignore_cleanup_errors=True) as store_path:
+        try:
+            asyncio.run(replay(records, args.speed, args.matrix_latency, store_path))
+        except KeyboardInterrupt:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
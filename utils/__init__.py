@@ -1 +1,2 @@
 from .singleton import SingletonMixin
+from .rate_limiter import TokenBucketLimiter
@@ -0,0 +1,52 @@
+import heapq
+
+
+class TokenBucketLimiter:
+    """Keyed token buckets: ``capacity`` tokens, refilled over ``period`` seconds.
+
+    Each bucket is a two-item list ``[tokens, last_refill]`` so a check is a
+    dict lookup plus a little float math.
+    """
+
+    __slots__ = ("capacity", "rate", "max_keys", "_buckets")
+
+    def __init__(self, capacity: float, period: float, max_keys: int = 10000):
+        self.capacity = float(capacity)
+        self.rate = self.capacity / period
+        self.max_keys = max_keys
+        self._buckets: dict[str, list[float]] = {}
+
+    def peek(self, key: str, now: float) -> float:
+        """Refill the bucket for ``key`` and return its current tokens."""
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            if len(self._buckets) >= self.max_keys:
+                self._prune(now)
+            bucket = self._buckets[key] = [self.capacity, now]
+            return self.capacity
+        tokens = bucket[0] + (now - bucket[1]) * self.rate
+        if tokens > self.capacity:
+            tokens = self.capacity
+        bucket[0] = tokens
+        bucket[1] = now
+        return tokens
+
+    def consume(self, key: str, cost: float = 1.0) -> None:
+        """Take ``cost`` tokens; call only after :meth:`peek` on the same key."""
+        self._buckets[key][0] -= cost
+
+    def _prune(self, now: float) -> None:
+        # 满桶与新建桶等价，可直接丢弃
+        full = [
+            k for k, (tokens, stamp) in self._buckets.items()
+            if tokens + (now - stamp) * self.rate >= self.capacity
+        ]
+        for k in full:
+            del self._buckets[k]
+        if len(self._buckets) < self.max_keys:
+            return
+        # 没有满桶可丢时，淘汰最久未使用的十分之一，保证字典不超过 max_keys
+        count = len(self._buckets) - self.max_keys + max(1, self.max_keys // 10)
+        stale = heapq.nsmallest(count, self._buckets.items(), key=lambda item: item[1][1])
+        for k, _ in stale:
+            del self._buckets[k]